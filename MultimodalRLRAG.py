@@ -5,7 +5,13 @@ import math
 import random
 from io import BytesIO
 from openai import OpenAI
-from PIL import Image, ImageDraw
+from PIL import Image
+
+from blobstore import BlobHandle, MemoryBlobStore
+from events import Event, ImageRef
+from memwatch import run_guard
+from recall import RecallStore
+from tools import Tool, ToolRegistry, Observation
 
 # 提示词模板：修复分隔符格式错误
 prompt_ins = '''Answer the given question. You must conduct reasoning inside <RichMediaReference> and <|FunctionCallEnd|> first. 
@@ -26,16 +32,47 @@ class MultimodalRLVRAG:
         self.min_pixels = 256 * 28 * 28
         self.max_steps = 10  # 最大推理步骤
 
-        # 存储检索历史
-        self.visual_recall = []
-        self.text_recall = []
-        self.table_recall = []
+        # 检索到的图像放在内存 blob store 中，检索接口只返回句柄，不落盘；
+        # 需要长期保留的图像会转存到 recall，这里只保留最近的少量图像
+        self.blobs = MemoryBlobStore(max_items=16)
+
+        # 工具注册表：标签与提示词一致，模拟检索无网络开销，成本记为0
+        self.tools = ToolRegistry([
+            Tool('text_search', 'search_text',
+                 fn=lambda agent, q, timeout: agent.recall_or_search('text', q, agent.search_text),
+                 observe=MultimodalRLVRAG.observe_text, search=True),
+            Tool('image_search', 'search_visual',
+                 fn=lambda agent, q, timeout: agent.recall_or_search('image', q, agent.search_visual),
+                 observe=MultimodalRLVRAG.observe_visual, search=True),
+            Tool('table_search', 'search_table',
+                 fn=lambda agent, q, timeout: agent.recall_or_search('table', q, agent.search_table),
+                 observe=MultimodalRLVRAG.observe_table, search=True),
+            Tool('crop', 'bbox', fn=lambda agent, content, timeout: None,
+                 observe=MultimodalRLVRAG.observe_crop),
+        ])
+
+        # 会话级检索历史：按内容去重、限制条数，同一查询在后续问题中直接复用
+        self.recall = RecallStore()
+        # 当前问题最近一次看到的图像（检索或裁剪得到），裁剪在它上面进行
+        self.current_image = None
+
+        # 内存看门狗和按问题的分配分析（memwatch），默认关闭
+        self.watchdog = None
+        self.profiler = None
+
+    def release(self):
+        """清空检索历史和 blob store（内存回收时调用）"""
+        self.recall.clear()
+        self.blobs.clear()
+        self.current_image = None
 
     def process_image(self, image):
         """处理图像：调整尺寸并转为base64"""
         try:  # 增加异常处理
-            # 处理输入类型（支持路径、Image对象）
-            if isinstance(image, str):
+            # 处理输入类型（支持句柄、路径、Image对象）
+            if isinstance(image, BlobHandle):
+                image = image.open()
+            elif isinstance(image, str):
                 image = Image.open(image)
             
             # 调整尺寸到像素范围
@@ -84,7 +121,7 @@ class MultimodalRLVRAG:
         return mock_data.get(query, [f"关于「{query}」的信息：这是模拟的文本检索结果"])
 
     def search_visual(self, query):
-        """模拟图像检索：生成随机颜色的测试图片"""
+        """模拟图像检索：生成随机颜色的测试图片，返回 blob 句柄"""
         try:  # 增加异常处理
             print(f"[模拟图像检索] 查询: {query}")
             # 生成随机尺寸和颜色的图片
@@ -95,10 +132,8 @@ class MultimodalRLVRAG:
                 random.randint(100, 255)   # B
             )
             img = Image.new("RGB", (width, height), color=color)
-            # 保存为临时文件（当前目录）
-            img_path = f"mock_{query.replace(' ', '_')}.jpg"
-            img.save(img_path)
-            return [img_path]
+            # 放入内存 blob store，返回句柄而不是临时文件路径
+            return [self.blobs.put(img)]
         except Exception as e:
             print(f"图像生成错误: {e}")
             return []  # 返回空列表避免崩溃
@@ -131,6 +166,79 @@ class MultimodalRLVRAG:
         }
         return mock_data.get(query, [f"关于「{query}」的表格：这是模拟的表格结果"])
 
+    def recall_or_search(self, kind, query, search):
+        """先查会话内的检索历史，没有时再检索并把结果存入历史
+
+        图像结果转存到 recall 中，返回指向 recall 的句柄，不受 blob store 淘汰影响。
+        """
+        recalled = self.recall.lookup(kind, query)
+        if recalled:
+            print(f"[检索历史命中] {kind}: {query}")
+            if kind == 'image':
+                return [BlobHandle(key, self.recall) for key, _ in recalled]
+            return [value for _, value in recalled]
+
+        results = search(query)
+        if kind != 'image':
+            for value in results:
+                self.recall.add(kind, query, value)
+            return results
+        handles = []
+        for handle in results:
+            key = self.recall.add('image', query, handle.open(), key=handle.key)
+            handles.append(BlobHandle(key, self.recall))
+        return handles
+
+    # --------------------------
+    # 工具结果处理：把检索结果转成回给模型的消息和界面事件
+    # --------------------------
+    def observe_text(self, content, raw_content, text_results):
+        return Observation(
+            [{"type": "text", "text": "\n".join(text_results)}],
+            [Event('search_text', text_results, raw_content)]
+        )
+
+    def observe_table(self, content, raw_content, table_results):
+        return Observation(
+            [{"type": "text", "text": "\n".join(table_results)}],
+            [Event('search_table', table_results, raw_content)]
+        )
+
+    def observe_visual(self, content, raw_content, img_handles):
+        if not img_handles:
+            return Observation(None, [Event('error', '未找到图像', '')])
+        image_raw = img_handles[0].open()
+        image_input, img_base64 = self.process_image(image_raw)
+        if not image_input:  # 检查图像处理是否成功
+            return Observation(None, [Event('error', '图像处理失败', '')])
+        self.current_image = image_input
+        return Observation(
+            [{"type": "image_url", "image_url": {"url": img_base64}}],
+            [Event('search_visual', ImageRef(image_input), raw_content)],
+            new_image=True
+        )
+
+    def observe_crop(self, content, raw_content, _):
+        if self.current_image is None:
+            return Observation(None, [Event('error', '无图像可裁剪', '')])
+        # 模拟裁剪（使用随机坐标）
+        img = self.current_image
+        bbox = [
+            random.randint(50, img.width//3),
+            random.randint(50, img.height//3),
+            random.randint(img.width//2, img.width-50),
+            random.randint(img.height//2, img.height-50)
+        ]
+        crop_region = img.crop(bbox)
+        image_input, img_base64 = self.process_image(crop_region)
+        self.current_image = crop_region
+        # 裁剪框（红色）只在消费者渲染时才绘制
+        image_to_draw = ImageRef(img, bbox, outline=(255, 0, 0), width=5)
+        return Observation(
+            [{"type": "image_url", "image_url": {"url": img_base64}}],
+            [Event('crop_image', (image_to_draw, ImageRef(image_input)), json.dumps(bbox))]
+        )
+
     # --------------------------
     # 模拟模型响应（无需真实模型服务）
     # --------------------------
@@ -161,6 +269,12 @@ class MultimodalRLVRAG:
     # 主运行逻辑
     # --------------------------
     def run(self, question):
+        with run_guard(self.profiler, self.watchdog, question):
+            result = yield from self._run(question)
+        return result
+
+    def _run(self, question):
+        self.current_image = None
         prompt = prompt_ins.format(question=question)
         messages = [{
             "role": "user",
@@ -181,12 +295,12 @@ class MultimodalRLVRAG:
                 # 提取推理过程
                 thought_match = re.search(r'(.*?)<|FunctionCallEnd|>', response_content, re.DOTALL)
                 thought = thought_match.group(1) if thought_match else "无推理过程"
-                yield 'think', thought, response_content
+                yield Event('think', thought, response_content)
 
                 # 提取操作指令
-                action_match = re.search(r'<(search_text|search_visual|search_table|bbox|answer)>(.*?)</\1>', response_content, re.DOTALL)
+                action_match = re.search(self.tools.action_pattern(), response_content, re.DOTALL)
                 if not action_match:
-                    yield 'error', '未识别到操作指令', ''
+                    yield Event('error', '未识别到操作指令')
                     break
                 action = action_match.group(1)
                 content = action_match.group(2).strip()
@@ -196,72 +310,20 @@ class MultimodalRLVRAG:
                 if action == 'answer':
                     return 'answer', content, "奖励分数: 8.5/10（模拟）"
 
-                # 执行对应操作
-                if action == 'search_text':
-                    text_results = self.search_text(content)
-                    self.text_recall.extend(text_results)
-                    messages.append({
-                        "role": "user",
-                        "content": [{"type": "text", "text": "\n".join(text_results)}]
-                    })
-                    yield 'search_text', text_results, raw_content
-
-                elif action == 'search_visual':
-                    img_paths = self.search_visual(content)
-                    if img_paths:
-                        image_raw = Image.open(img_paths[0])
-                        image_input, img_base64 = self.process_image(image_raw)
-                        if image_input:  # 检查图像处理是否成功
-                            self.visual_recall.append(image_input)
-                            messages.append({
-                                "role": "user",
-                                "content": [{"type": "image_url", "image_url": {"url": img_base64}}]
-                            })
-                            yield 'search_visual', image_input, raw_content
-                        else:
-                            yield 'error', '图像处理失败', ''
-                    else:
-                        yield 'error', '未找到图像', ''
-
-                elif action == 'search_table':
-                    table_results = self.search_table(content)
-                    self.table_recall.extend(table_results)
-                    messages.append({
-                        "role": "user",
-                        "content": [{"type": "text", "text": "\n".join(table_results)}]
-                    })
-                    yield 'search_table', table_results, raw_content
-
-                elif action == 'bbox':
-                    if not self.visual_recall:
-                        yield 'error', '无图像可裁剪', ''
-                        max_steps -= 1
-                        continue
-                    # 模拟裁剪（使用随机坐标）
-                    img = self.visual_recall[-1]
-                    bbox = [
-                        random.randint(50, img.width//3),
-                        random.randint(50, img.height//3),
-                        random.randint(img.width//2, img.width-50),
-                        random.randint(img.height//2, img.height-50)
-                    ]
-                    crop_region = img.crop(bbox)
-                    image_input, img_base64 = self.process_image(crop_region)
-                    self.visual_recall.append(crop_region)
-                    # 绘制裁剪框
-                    image_to_draw = img.copy()
-                    draw = ImageDraw.Draw(image_to_draw)
-                    draw.rectangle(bbox, outline=(255, 0, 0), width=5)  # 红色框
+                # 通过工具注册表执行对应操作
+                observation = self.tools.dispatch(self, action, content, raw_content)
+                if observation.user_content is not None:
                     messages.append({
                         "role": "user",
-                        "content": [{"type": "image_url", "image_url": {"url": img_base64}}]
+                        "content": observation.user_content
                     })
-                    yield 'crop_image', (image_to_draw, image_input), json.dumps(bbox)
+                for event in observation.events:
+                    yield Event.of(event)
 
                 max_steps -= 1
 
             except Exception as e:
-                yield 'error', f"运行出错: {str(e)}", ''
+                yield Event('error', f"运行出错: {str(e)}")
                 break
 
         # 步骤耗尽时返回
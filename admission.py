@@ -0,0 +1,194 @@
+import heapq
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+
+# 优先级：数值越小越优先，交互请求排在批量任务之前
+INTERACTIVE = 0
+BATCH = 1
+
+
+class SchedulerSaturated(Exception):
+    """系统已饱和，新的问题或调用被拒绝"""
+
+
+class TokenBucket:
+    """令牌桶限速：rate 为每秒补充的令牌数，capacity 为允许的突发量"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(rate, 1))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, tokens=1, timeout=None):
+        """取出令牌，不够时等待；超时返回False"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return True
+                wait = (tokens - self.tokens) / self.rate
+            if deadline is not None:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return False
+                wait = min(wait, left)
+            time.sleep(wait)
+
+    def drain(self, seconds=1.0):
+        """后端返回限流错误时清空令牌，并让桶在 seconds 秒后才恢复"""
+        with self.lock:
+            self._refill()
+            self.tokens = -seconds * self.rate
+
+
+class PriorityLimiter:
+    """并发上限 + 优先级排队：空出的名额总是先给优先级最高、等待最久的请求"""
+
+    def __init__(self, max_concurrency):
+        self.max_concurrency = max_concurrency
+        self.active = 0
+        self.waiters = []
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+
+    @property
+    def waiting(self):
+        return len(self.waiters)
+
+    def acquire(self, priority=INTERACTIVE, timeout=None):
+        with self.cond:
+            entry = (priority, next(self.counter))
+            heapq.heappush(self.waiters, entry)
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while not (self.waiters[0] == entry and self.active < self.max_concurrency):
+                left = None if deadline is None else deadline - time.monotonic()
+                if left is not None and left <= 0:
+                    self.waiters.remove(entry)
+                    heapq.heapify(self.waiters)
+                    self.cond.notify_all()
+                    return False
+                self.cond.wait(left)
+            heapq.heappop(self.waiters)
+            self.active += 1
+            self.cond.notify_all()
+            return True
+
+    def release(self):
+        with self.cond:
+            self.active -= 1
+            self.cond.notify_all()
+
+
+class Backend:
+    """一个后端（模型服务、搜索API等）的并发上限和速率限制"""
+
+    def __init__(self, name, max_concurrency, rate=None, burst=None):
+        self.name = name
+        self.limiter = PriorityLimiter(max_concurrency)
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.calls = 0
+        self.throttled = 0
+
+
+class AdmissionScheduler:
+    """共享调度器：按后端限制并发和速率，并在系统饱和时尽早拒绝新问题
+
+    - slot(backend) 包住每一次模型/搜索调用
+    - admit() 包住整个问题的推理循环，排队超过上限时抛出 SchedulerSaturated
+    """
+
+    def __init__(self, max_active_questions=8, max_queued_questions=16, max_queued_batch=4, queue_timeout=30):
+        self.questions = PriorityLimiter(max_active_questions)
+        self.max_queued_questions = max_queued_questions
+        self.max_queued_batch = max_queued_batch
+        self.queue_timeout = queue_timeout
+        self.backends = {}
+        self.rejected = 0
+
+    def add_backend(self, name, max_concurrency, rate=None, burst=None):
+        self.backends[name] = Backend(name, max_concurrency, rate, burst)
+        return self.backends[name]
+
+    @contextmanager
+    def slot(self, backend, priority=INTERACTIVE, timeout=None):
+        """占用一个后端调用名额；backend 未注册时不做限制"""
+        backend = self.backends.get(backend)
+        if backend is None:
+            yield
+            return
+        timeout = self.queue_timeout if timeout is None else timeout
+        if not backend.limiter.acquire(priority, timeout):
+            raise SchedulerSaturated(f'{backend.name} 并发已满，等待超时')
+        try:
+            if backend.bucket is not None and not backend.bucket.acquire(timeout=timeout):
+                raise SchedulerSaturated(f'{backend.name} 速率受限，等待超时')
+            backend.calls += 1
+            yield
+        finally:
+            backend.limiter.release()
+
+    def throttle(self, backend, retry_after=1.0):
+        """后端报告限流（如HTTP 429）时暂停发放令牌"""
+        backend = self.backends.get(backend)
+        if backend is None:
+            return
+        backend.throttled += 1
+        if backend.bucket is not None:
+            backend.bucket.drain(retry_after)
+
+    @contextmanager
+    def admit(self, priority=INTERACTIVE, timeout=None):
+        """准入控制：排队过长时直接拒绝，批量任务的排队上限更低"""
+        limit = self.max_queued_questions if priority == INTERACTIVE else self.max_queued_batch
+        if self.questions.waiting >= limit:
+            self.rejected += 1
+            raise SchedulerSaturated('系统繁忙，请稍后再试')
+        timeout = self.queue_timeout if timeout is None else timeout
+        if not self.questions.acquire(priority, timeout):
+            self.rejected += 1
+            raise SchedulerSaturated('排队超时，请稍后再试')
+        try:
+            yield
+        finally:
+            self.questions.release()
+
+    def stats(self):
+        stats = {
+            'active_questions': self.questions.active,
+            'queued_questions': self.questions.waiting,
+            'rejected': self.rejected,
+        }
+        for name, backend in self.backends.items():
+            stats[name] = {
+                'active': backend.limiter.active,
+                'queued': backend.limiter.waiting,
+                'calls': backend.calls,
+                'throttled': backend.throttled,
+            }
+        return stats
+
+
+_default_scheduler = None
+_default_lock = threading.Lock()
+
+
+def default_scheduler():
+    """进程内共享的调度器，所有 Streamlit 会话共用同一组限制"""
+    global _default_scheduler
+    with _default_lock:
+        if _default_scheduler is None:
+            _default_scheduler = AdmissionScheduler()
+            _default_scheduler.add_backend('llm', max_concurrency=8)
+            _default_scheduler.add_backend('serper', max_concurrency=4, rate=5, burst=5)
+        return _default_scheduler
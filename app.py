@@ -1,8 +1,13 @@
+import copy
+import os
+import time
+import uuid
 import streamlit as st
-import pandas as pd
 from vrag import VRAG
+from admission import SchedulerSaturated
 from PIL import Image
-from time import sleep
+from thumbnails import show_image
+from events import ImageRef
 
 # ============ 页面配置 ============
 st.set_page_config(
@@ -45,6 +50,14 @@ MAX_ROUNDS = st.sidebar.slider(
     help="限制模型的最大搜索次数"
 )
 
+DEADLINE = st.sidebar.slider(
+    "⏱️ 回答时限（秒）",
+    min_value=10,
+    max_value=120,
+    value=60,
+    help="时间紧张时跳过裁剪、降低图像分辨率，并在时限前强制给出答案"
+)
+
 multimodal_weight = st.sidebar.slider(
     "🔗 多模态对齐权重",
     min_value=0.0,
@@ -103,11 +116,22 @@ with col_info:
 @st.cache_resource
 def load_agent():
     """加载VRAG Agent"""
+    # 多个 vLLM 副本用逗号分隔，例如 http://a:8000/v1,http://b:8000/v1
     agent = VRAG(
-        base_url='http://localhost:8000/v1',
+        base_url=os.getenv('VLLM_BASE_URLS', 'http://localhost:8000/v1').split(','),
         generator=True,
-        api_key='EMPTY'
+        api_key='EMPTY',
+        stream=True,
+        # VRAG_GUIDED=1 时启用约束解码（需要 vLLM 支持 structured outputs）
+        guided=os.getenv('VRAG_GUIDED') == '1',
+        # VRAG_MEDIA_DIR 设置时图像以 file:// 引用发给模型（vLLM 需 --allowed-local-media-path）
+        media=os.getenv('VRAG_MEDIA_DIR')
     )
+    # 预热连接池和模型前缀缓存，失败不影响页面加载
+    try:
+        agent.warmup()
+    except Exception as e:
+        print(f"预热失败: {e}")
     return agent
 
 try:
@@ -116,8 +140,60 @@ except Exception as e:
     st.error(f"❌ 无法加载VRAG Agent: {str(e)}")
     st.stop()
 
-# ============ 结果展示区域 ============
+# ============ 运行状态持久化 ============
+# 每个会话按 (问题, 配置) 保存运行：已产生的事件和尚未结束的生成器。
+# 勾选框、对齐权重等只影响展示的控件触发 rerun 时，直接从保存的事件重新渲染，不再重复调用模型和搜索；
+# 只有问题、最大步数或回答时限变化后再次提交才会启动新的运行。
+# 每个运行使用缓存 agent 的独立副本（共享客户端、副本路由、调度器和工具注册表），
+# 挂起的生成器在之后的 rerun 中恢复时，图像、截止时间和副本会话不会被其他会话或运行改写。
+MAX_SAVED_RUNS = 5
+runs = st.session_state.setdefault('runs', {})
+run_key = (question, MAX_ROUNDS, DEADLINE)
 if submit_button and question:
+    # 提交了其他问题：关闭之前未完成的运行，立即断开它们进行中的模型请求；再次提交时重新运行
+    for key, saved in runs.items():
+        if key != run_key and not saved['done']:
+            saved['generator'].close()
+            saved['done'] = True
+            saved['error'] = '已取消'
+    if run_key not in runs or runs[run_key]['error']:
+        runs.pop(run_key, None)
+        run_agent = copy.copy(agent)
+        runs[run_key] = {
+            'id': uuid.uuid4().hex,  # 原图按钮等控件的 key 按运行区分
+            'events': [],
+            'agent': run_agent,
+            'generator': run_agent.run(question, max_steps=MAX_ROUNDS, deadline=DEADLINE),
+            'done': False,
+            'error': None
+        }
+        # 只保留最近几次运行，关闭被淘汰的生成器以释放占用的名额
+        while len(runs) > MAX_SAVED_RUNS:
+            oldest = runs.pop(next(iter(runs)))
+            oldest['generator'].close()
+    st.session_state['active_run'] = run_key
+active_run = runs.get(st.session_state.get('active_run'))
+
+
+def run_events(active_run):
+    """先回放已保存的事件，再继续消费未完成的生成器（流式增量不保存）"""
+    yield from list(active_run['events'])
+    if active_run['done']:
+        return
+    try:
+        for event in active_run['generator']:
+            if event[0] != 'delta':
+                active_run['events'].append(event)
+            yield event
+        active_run['done'] = True
+    except Exception as e:
+        active_run['done'] = True
+        active_run['error'] = str(e)
+        raise
+
+
+# ============ 结果展示区域 ============
+if active_run is not None:
     st.markdown("---")
     st.markdown("### 📊 分析过程与结果")
     
@@ -143,8 +219,7 @@ if submit_button and question:
     answer_container = st.container()
     
     # ============ 生成器处理逻辑 ============
-    agent.max_steps = MAX_ROUNDS
-    generator = agent.run(question)
+    generator = run_events(active_run)
     
     # 存储多模态结果
     multimodal_data = {
@@ -152,25 +227,45 @@ if submit_button and question:
         'image_results': [],
         'table_results': [],
         'thinking_steps': [],
-        'alignment_scores': []
+        'alignment_scores': [],
+        'trajectory': []
     }
     
     try:
         step_count = 0
+        # 模型输出边生成边显示，当前步骤结束后由思考步骤的展开框替代
+        with process_container:
+            live_output = st.empty()
+        streamed_text = ''
+        # 限制重绘频率：每次重绘都会把累计文本整体发给浏览器，逐 token 重绘时总传输量随长度平方增长
+        STREAM_INTERVAL = 0.1
+        rendered_at = 0.0
         
         for action, content, raw_content in generator:
+            # ============ 流式输出 ============
+            if action == 'delta':
+                streamed_text += content
+                now = time.monotonic()
+                if now - rendered_at >= STREAM_INTERVAL:
+                    live_output.text(streamed_text)
+                    rendered_at = now
+                continue
+            
             step_count += 1
+            multimodal_data['trajectory'].append((action, content, raw_content))
             
             # ============ 思考步骤 ============
             if action == 'think':
+                live_output.empty()
+                streamed_text = ''
                 thinking_step = f"**步骤 {step_count}** - 🤔 思考中..."
                 multimodal_data['thinking_steps'].append(thinking_step)
                 
                 with process_container:
                     with st.expander(f"🤔 思考步骤 {step_count}"):
                         st.write(content[:200] + "..." if len(content) > 200 else content)
-                
-                sleep(0.2)
+                    # 下一步的流式输出显示在本步骤之后
+                    live_output = st.empty()
             
             # ============ 文字搜索 ============
             elif action == 'search_text':
@@ -185,10 +280,10 @@ if submit_button and question:
             elif action == 'search_image':
                 if enable_visual_search:
                     try:
-                        if isinstance(content, Image.Image):
+                        if isinstance(content, (Image.Image, ImageRef)):
                             with image_container:
                                 st.success("✓ 检索到图像")
-                                st.image(content, use_column_width=True)
+                                show_image(content, width=400, key=f"full_{active_run['id']}_{step_count}")
                                 multimodal_data['image_results'].append(content)
                     except Exception as e:
                         with image_container:
@@ -198,10 +293,10 @@ if submit_button and question:
             elif action == 'search':
                 if enable_visual_search:
                     try:
-                        if isinstance(content, Image.Image):
+                        if isinstance(content, (Image.Image, ImageRef)):
                             with image_container:
                                 st.success("✓ 检索到图像")
-                                st.image(content, use_column_width=True)
+                                show_image(content, width=400, key=f"full_{active_run['id']}_{step_count}")
                                 multimodal_data['image_results'].append(content)
                         else:
                             # 作为文字处理
@@ -219,6 +314,7 @@ if submit_button and question:
                     with table_container:
                         st.success("✓ 提取表格数据")
                         try:
+                            import pandas as pd  # 仅在表格结果出现时导入
                             if isinstance(content, pd.DataFrame):
                                 st.dataframe(content, use_container_width=True)
                             else:
@@ -234,9 +330,9 @@ if submit_button and question:
                         with st.expander("🔍 已裁剪关键区域"):
                             if isinstance(content, tuple) and len(content) == 2:
                                 # content 可能是 (cropped_image, marked_image)
-                                st.image(content[0], use_column_width=True)
-                            elif isinstance(content, Image.Image):
-                                st.image(content, use_column_width=True)
+                                show_image(content[0], width=400, key=f"full_{active_run['id']}_{step_count}")
+                            elif isinstance(content, (Image.Image, ImageRef)):
+                                show_image(content, width=400, key=f"full_{active_run['id']}_{step_count}")
                 except Exception as e:
                     st.warning(f"裁剪显示失败: {str(e)}")
             
@@ -272,6 +368,21 @@ if submit_button and question:
                             help="提取的表格数量"
                         )
                     
+                    from reward import batch_reward  # numpy 按需导入
+                    # 没有标准答案时只计算对齐项：答案在检索证据中的命中率，按对齐权重加权
+                    scores = batch_reward(
+                        [content], [''], [multimodal_data['trajectory']],
+                        multimodal_weight=multimodal_weight
+                    )
+                    alignment = float(scores['alignment'][0])
+                    multimodal_data['alignment_scores'].append(alignment)
+                    col_align1, col_align2 = st.columns(2)
+                    with col_align1:
+                        st.metric("🔗 多模态对齐得分", f"{alignment:.2f}")
+                    with col_align2:
+                        st.metric("⚖️ 加权对齐项", f"{multimodal_weight * alignment:.2f}",
+                                  help="对齐得分 × 多模态对齐权重，即Reward中的多模态项")
+                    
                     # 对齐信息说明
                     st.info("""
                     **系统采用以下多模态对齐策略：**
@@ -285,6 +396,9 @@ if submit_button and question:
     except StopIteration:
         st.info("✓ 处理完成")
     
+    except SchedulerSaturated as e:
+        st.warning(f"⏳ 系统繁忙：{str(e)}")
+    
     except Exception as e:
         st.error(f"❌ 处理过程中出错：{str(e)}")
         import traceback
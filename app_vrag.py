@@ -1,7 +1,12 @@
+import copy
+import html
+import os
+import time
 import streamlit as st
 from vrag import VRAG
+from admission import SchedulerSaturated
 from PIL import Image
-from time import sleep
+from thumbnails import show_image
 
 # Set page configuration
 st.set_page_config(
@@ -11,19 +16,47 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-def typewriter_effect(container, text, delay=0.02):
-    # This function simulates a typewriter effect by gradually appending characters
-    final_text = ''
-    for char in text:
-        # Append character
-        final_text += char
-        # Safeguard HTML brackets
-        text_for_display = final_text.replace("<", "&lt;").replace(">", "&gt;")
-        # Output to streamlit
-        container.markdown(f'<div class="info-box">{text_for_display}</div>', unsafe_allow_html=True)
-        sleep(delay)
-    container.markdown(f'<div class="info-box">{text}</div>', unsafe_allow_html=True)
-    
+class StreamingBox:
+    """Render streamed model output into one placeholder, appending deltas as they arrive"""
+
+    def __init__(self, min_interval=0.05):
+        self.placeholder = st.empty()
+        self.text = ''
+        self.min_interval = min_interval
+        self.rendered_at = 0.0
+
+    def append(self, delta):
+        self.text += delta
+        # Throttle re-renders so a fast stream does not re-send the block for every token
+        now = time.monotonic()
+        if now - self.rendered_at >= self.min_interval:
+            self.show(html.escape(self.text))
+            self.rendered_at = now
+
+    def show(self, markup):
+        self.placeholder.markdown(f'<div class="info-box">{markup}</div>', unsafe_allow_html=True)
+
+
+@st.cache_resource
+def load_agent():
+    # VRAG_CORPUS 指向 corpus.py 生成的页面语料库目录时，检索本地文档而不是网页
+    agent = VRAG(stream=True, corpus=os.getenv('VRAG_CORPUS'))
+    try:
+        agent.warmup()
+    except Exception as e:
+        print(f"Warm-up failed: {e}")
+    return agent
+
+
+def session_agent():
+    """Per-session copy of the cached agent
+
+    The copy shares clients, replica router, scheduler and tool registry with the cached agent,
+    while per-run state (images, deadline, replica session) stays separate between users.
+    """
+    if 'agent' not in st.session_state:
+        st.session_state['agent'] = copy.copy(load_agent())
+    return st.session_state['agent']
 
 
 def main():
@@ -94,13 +127,14 @@ def main():
     </style>
     """, unsafe_allow_html=True)
 
-    # Initialize VRAG agent
-    agent = VRAG()
+    # Shared parts are created and warmed up once per server process; each session runs on its own copy
+    agent = session_agent()
 
     # Sidebar configuration
     with st.sidebar:
         st.markdown('<p class="sidebar-header">⚙️ Configuration Options</p>', unsafe_allow_html=True)
         MAX_ROUNDS = st.number_input('Number of Max Reasoning Iterations:', min_value=3, max_value=10, value=10, step=1)
+        DEADLINE = st.number_input('Answer Deadline (seconds):', min_value=10, max_value=120, value=60, step=5)
         selected_example = st.selectbox(
             'Examples:', 
             ["What is the most commonly used travel app?", 
@@ -112,7 +146,6 @@ def main():
     # Question input box and button placed at the top of the page
     st.markdown('<p class="header-text">📝 Enter Your Question:</p>', unsafe_allow_html=True)
 
-    agent.max_steps = MAX_ROUNDS
     question = st.text_input(
         "Question Input:",
         placeholder="Type your question here...",
@@ -131,46 +164,56 @@ def main():
     result_container = st.container()
     with result_container:
         if submit_button and question:
-            generator = agent.run(question)
+            generator = agent.run(question, max_steps=MAX_ROUNDS, deadline=DEADLINE)
             image_width = 350
+            box = None       # box currently receiving streamed deltas
+            step_box = None  # box of the finished step, updated with its action
+            think = ''
             try:
-                while True:
-                    action, content, raw_content = next(generator)
-                    if action == 'think':
-                        sleep(0.5)
-                        think = f"💭 Thinking: {content}"
+                for step, (action, content, raw_content) in enumerate(generator):
+                    if action == 'delta':
+                        # A new model step starts streaming into a fresh box
+                        if box is None:
+                            box = StreamingBox()
+                        box.append(content)
+                    elif action == 'think':
+                        # The step finished streaming; the next delta starts a new box
+                        think = f"💭 Thinking: {html.escape(content)}"
+                        step_box = box or StreamingBox()
+                        step_box.show(think)
+                        box = None
                     elif action == 'search':
-                        typewriter_effect(st.empty(), f'{think} <br> 🔍 <strong>Call Search Engine: {content}</strong>')
-                        
-                        # st.markdown(f'<div class="info-box">{think} <br> 🔍 Searching: {content}</div>', unsafe_allow_html=True)
+                        step_box.show(f'{think} <br> 🔍 <strong>Call Search Engine: {html.escape(content)}</strong>')
                     elif action == 'bbox':
                         bbox_str = content
-                        typewriter_effect(st.empty(), f'{think} <br> 📷 <strong>Region of Interest: {content}</strong>')
-                        # st.markdown(f'<div class="info-box">{think} <br> 📷 Region of Interest: {content}</div>', unsafe_allow_html=True)
+                        step_box.show(f'{think} <br> 📷 <strong>Region of Interest: {html.escape(content)}</strong>')
                     elif action == 'search_image':
                         col1, col2 = st.columns(2)
                         with col1:
                             st.markdown(f'<p class="caption">Retrieved Image</p>', unsafe_allow_html=True)
                             st.markdown('<div class="small-image">', unsafe_allow_html=True)
-                            st.image(content, width=image_width)
+                            show_image(content, width=image_width)
                             st.markdown('</div>', unsafe_allow_html=True)
                     elif action == 'crop_image':
                         col1, col2 = st.columns(2)
                         with col1:
                             st.markdown(f'<p class="caption">🤔 Image with bbox: <span style="color:purple;">{bbox_str}</span></p>', unsafe_allow_html=True)
                             st.markdown('<div class="small-image">', unsafe_allow_html=True)
-                            st.image(raw_content, width=image_width) 
+                            show_image(raw_content, width=image_width)
                             st.markdown('</div>', unsafe_allow_html=True)
-                        sleep(0.5)
                         with col2:
                             st.markdown(f'<p class="caption">✂️ Cropped Region</p>', unsafe_allow_html=True)
                             st.markdown('<div class="small-image">', unsafe_allow_html=True)
-                            st.image(content, width=image_width) 
+                            show_image(content, width=image_width)
                             st.markdown('</div>', unsafe_allow_html=True)
-            except StopIteration as e:
-                action, content, raw_response = e.value
-                if action == 'answer':
-                    st.success(f"✅ Answer: {content}")
+                    elif action == 'answer':
+                        st.success(f"✅ Answer: {content}")
+            except SchedulerSaturated as e:
+                st.warning(f"⏳ Server busy: {e}")
+            finally:
+                # Submitting again or closing the tab stops this script run; close the generator
+                # right away so the in-flight model stream is aborted instead of running to completion
+                generator.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
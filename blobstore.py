@@ -0,0 +1,108 @@
+import hashlib
+import os
+import threading
+import uuid
+from collections import OrderedDict
+
+from PIL import Image
+
+
+def image_hash(image):
+    """按像素内容计算图像哈希，相同图像只存一份"""
+    h = hashlib.sha1()
+    h.update(f'{image.mode}:{image.size[0]}x{image.size[1]}:'.encode())
+    h.update(image.tobytes())
+    return h.hexdigest()
+
+
+class BlobHandle:
+    """检索结果的句柄：只携带内容哈希，需要时再从所属的 store 取出图像"""
+
+    __slots__ = ('key', 'store')
+
+    def __init__(self, key, store):
+        self.key = key
+        self.store = store
+
+    def open(self):
+        return self.store.get(self.key)
+
+    def __eq__(self, other):
+        return isinstance(other, BlobHandle) and other.key == self.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __repr__(self):
+        return f'BlobHandle({self.key[:12]})'
+
+
+class MemoryBlobStore:
+    """内存中的 blob store（默认）：直接保存 PIL 图像对象，不经过编码和磁盘
+
+    max_items 不为空时按 LRU 淘汰最久未使用的图像。
+    """
+
+    def __init__(self, max_items=None):
+        self.max_items = max_items
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def put(self, image):
+        key = image_hash(image)
+        with self.lock:
+            if key in self.items:
+                self.items.move_to_end(key)
+            else:
+                self.items[key] = image
+                if self.max_items is not None:
+                    while len(self.items) > self.max_items:
+                        self.items.popitem(last=False)
+        return BlobHandle(key, self)
+
+    def get(self, key):
+        with self.lock:
+            image = self.items.get(key)
+            if image is None:
+                raise KeyError(f'blob 不存在或已被淘汰: {key}')
+            self.items.move_to_end(key)
+            return image
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+class DiskBlobStore:
+    """磁盘上的 blob store：按内容哈希命名（<key>.png），只在需要持久化时使用"""
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.root, f'{key}.png')
+
+    def put(self, image):
+        key = image_hash(image)
+        path = self.path(key)
+        if not os.path.exists(path):
+            # 先写临时文件再改名，避免并发写入时读到半个文件
+            tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+            image.save(tmp_path, format='PNG')
+            os.replace(tmp_path, path)
+        return BlobHandle(key, self)
+
+    def get(self, key):
+        image = Image.open(self.path(key))
+        image.load()
+        return image
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key))
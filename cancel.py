@@ -0,0 +1,70 @@
+import threading
+from contextlib import contextmanager
+
+
+class Cancelled(Exception):
+    """运行已被取消：消费者关闭了生成器，或在其他线程调用了 CancelToken.cancel"""
+
+
+class CancelToken:
+    """一次运行的取消信号，可以在任意线程中调用 cancel
+
+    进行中的请求通过 aborting 登记中止函数（如关闭流式响应），取消时立即调用，
+    模型服务发现连接断开后即可释放该请求占用的名额；取消之后再登记的中止函数会被立即调用。
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.reason = None
+        self.aborts = {}
+        self.lock = threading.Lock()
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def cancel(self, reason='cancelled'):
+        """发出取消信号并中止所有进行中的请求；已经取消过时返回 False"""
+        with self.lock:
+            if self.event.is_set():
+                return False
+            self.reason = reason
+            self.event.set()
+            aborts = list(self.aborts.values())
+            self.aborts.clear()
+        for abort in aborts:
+            try:
+                abort()
+            except Exception as e:
+                print(f"中止请求失败: {e}")
+        return True
+
+    def check(self):
+        """已取消时抛出 Cancelled，在发起新请求之前调用"""
+        if self.event.is_set():
+            raise Cancelled(self.reason)
+
+    @contextmanager
+    def aborting(self, abort):
+        """with 块执行期间登记中止函数 abort
+
+        块内的请求因被中止而失败或提前结束时统一抛出 Cancelled，调用方不会误用不完整的结果。
+        """
+        key = object()
+        with self.lock:
+            registered = not self.event.is_set()
+            if registered:
+                self.aborts[key] = abort
+        if not registered:
+            abort()
+            raise Cancelled(self.reason)
+        try:
+            yield
+        except Exception as e:
+            if self.event.is_set():
+                raise Cancelled(self.reason) from e
+            raise
+        finally:
+            with self.lock:
+                self.aborts.pop(key, None)
+        self.check()
@@ -0,0 +1,202 @@
+import argparse
+import json
+import mmap
+import os
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+from reranker import HashingEmbedder
+from vrag import fit_pixels
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff', '.webp')
+
+
+def iter_pages(paths, dpi=150):
+    """遍历文档集合中的每一页，产出 (文档名, 页码, 原分辨率 RGB 图像, 页面文本)
+
+    PDF 用 PyMuPDF 渲染（只在遇到 PDF 时导入）；图片文件视为单页，文本取同名 .txt 文件。
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.extend(os.path.join(root, name) for name in sorted(names))
+        else:
+            files.append(path)
+
+    for path in sorted(files):
+        stem, ext = os.path.splitext(path)
+        ext = ext.lower()
+        if ext == '.pdf':
+            import fitz
+            with fitz.open(path) as doc:
+                for number, page in enumerate(doc):
+                    pix = page.get_pixmap(dpi=dpi, alpha=False)
+                    image = Image.frombytes('RGB', (pix.width, pix.height), pix.samples)
+                    yield os.path.basename(path), number + 1, image, page.get_text()
+        elif ext in IMAGE_EXTENSIONS:
+            text = os.path.basename(stem)
+            if os.path.exists(stem + '.txt'):
+                with open(stem + '.txt', encoding='utf-8') as f:
+                    text = f.read()
+            image = Image.open(path)
+            yield os.path.basename(path), 1, image.convert('RGB'), text
+
+
+class _ShardWriter:
+    """把字节顺序追加到分片文件，单个分片超过 shard_bytes 后换下一个"""
+
+    def __init__(self, root, shard_bytes):
+        self.root = root
+        self.shard_bytes = shard_bytes
+        self.shards = []
+        self.file = None
+        self.size = 0
+
+    def write(self, data):
+        if self.file is None or self.size >= self.shard_bytes:
+            self.close()
+            name = f'shard-{len(self.shards):05d}.bin'
+            self.shards.append(name)
+            self.file = open(os.path.join(self.root, name), 'wb')
+            self.size = 0
+        offset = self.size
+        self.file.write(data)
+        self.size += len(data)
+        return len(self.shards) - 1, offset
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def ingest(paths, root, max_pixels=512 * 28 * 28, min_pixels=256 * 28 * 28, dpi=150,
+           shard_bytes=1 << 30, quality=95, text_chars=2000):
+    """把文档集合转换为页面图像语料库，写入 root 目录
+
+    每页在分片中保存三段数据：原分辨率 RGB 像素（供裁剪）、按 max_pixels/min_pixels 缩放后的 RGB 像素
+    （即 process_image 的 image_input）以及缩放图的 JPEG 字节（即发给模型的图像）。
+    index.json 记录每段的位置，embeddings.npy 保存页面文本的向量用于检索。
+    max_pixels 和 min_pixels 需要与 VRAG 的设置一致，否则检索时回退为现场缩放编码。
+    """
+    os.makedirs(root, exist_ok=True)
+    writer = _ShardWriter(root, shard_bytes)
+    embedder = HashingEmbedder()
+    pages, texts = [], []
+    try:
+        for doc, number, image, text in iter_pages(paths, dpi):
+            image_input = fit_pixels(image, max_pixels, min_pixels)
+            buf = BytesIO()
+            image_input.save(buf, format='JPEG', quality=quality)
+            jpeg = buf.getvalue()
+
+            entry = {'doc': doc, 'page': number, 'text': ' '.join(text.split())[:text_chars]}
+            for field, data, size in (
+                    ('raw', image.tobytes(), image.size),
+                    ('input', image_input.tobytes(), image_input.size),
+                    ('jpeg', jpeg, None)):
+                shard, offset = writer.write(data)
+                entry[field] = {'shard': shard, 'offset': offset, 'length': len(data)}
+                if size is not None:
+                    entry[field]['size'] = list(size)
+            pages.append(entry)
+            texts.append(f"{doc} {entry['text']}")
+            print(f"已写入 {doc} 第 {number} 页")
+    finally:
+        writer.close()
+
+    embeddings = embedder.embed(texts) if texts else np.zeros((0, embedder.dim), dtype=np.float32)
+    np.save(os.path.join(root, 'embeddings.npy'), embeddings)
+    with open(os.path.join(root, 'index.json'), 'w', encoding='utf-8') as f:
+        json.dump({
+            'max_pixels': max_pixels,
+            'min_pixels': min_pixels,
+            'embedding_dim': embedder.dim,
+            'shards': writer.shards,
+            'pages': pages
+        }, f, ensure_ascii=False)
+    return len(pages)
+
+
+class PageStore:
+    """只读的页面图像语料库：分片文件按需内存映射，取页面时直接引用映射内存，不解码也不复制
+
+    返回的 PIL 图像与映射内存共享数据，是只读的；裁剪、缩放等操作会生成新图像。
+    """
+
+    def __init__(self, root):
+        self.root = root
+        with open(os.path.join(root, 'index.json'), encoding='utf-8') as f:
+            index = json.load(f)
+        self.max_pixels = index['max_pixels']
+        self.min_pixels = index['min_pixels']
+        self.shards = index['shards']
+        self.pages = index['pages']
+        self.embedder = HashingEmbedder(index['embedding_dim'])
+        self.embeddings = np.load(os.path.join(root, 'embeddings.npy'), mmap_mode='r')
+        self._maps = {}
+
+    def __len__(self):
+        return len(self.pages)
+
+    def matches(self, max_pixels, min_pixels):
+        """预先缩放的页面是否与给定的分辨率设置一致"""
+        return self.max_pixels == max_pixels and self.min_pixels == min_pixels
+
+    def _view(self, location):
+        shard = location['shard']
+        if shard not in self._maps:
+            with open(os.path.join(self.root, self.shards[shard]), 'rb') as f:
+                self._maps[shard] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        offset = location['offset']
+        return memoryview(self._maps[shard])[offset:offset + location['length']]
+
+    def _image(self, location):
+        return Image.frombuffer('RGB', tuple(location['size']), self._view(location), 'raw', 'RGB', 0, 1)
+
+    def page(self, page_id):
+        """原分辨率页面"""
+        return self._image(self.pages[page_id]['raw'])
+
+    def page_input(self, page_id):
+        """按 max_pixels/min_pixels 缩放后的页面"""
+        return self._image(self.pages[page_id]['input'])
+
+    def page_jpeg(self, page_id):
+        """缩放后页面的 JPEG 字节"""
+        return bytes(self._view(self.pages[page_id]['jpeg']))
+
+    def search(self, query, k=5):
+        """按页面文本与查询的相似度返回前 k 个候选 {'url', 'title', 'source'}"""
+        if not self.pages:
+            return []
+        scores = np.asarray(self.embeddings @ self.embedder.embed([query])[0])
+        top = np.argsort(-scores, kind='stable')[:k]
+        return [
+            {
+                'url': f'corpus://{i}',
+                'title': self.pages[i]['text'][:200],
+                'source': f"{self.pages[i]['doc']} p.{self.pages[i]['page']}"
+            }
+            for i in top.tolist()
+        ]
+
+    def close(self):
+        for m in self._maps.values():
+            m.close()
+        self._maps.clear()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='把本地文档集合转换为 VRAG 页面图像语料库')
+    parser.add_argument('paths', nargs='+', help='PDF、图片文件或目录')
+    parser.add_argument('--out', required=True, help='语料库目录')
+    parser.add_argument('--dpi', type=int, default=150)
+    parser.add_argument('--max-pixels', type=int, default=512 * 28 * 28)
+    parser.add_argument('--min-pixels', type=int, default=256 * 28 * 28)
+    args = parser.parse_args()
+    count = ingest(args.paths, args.out, args.max_pixels, args.min_pixels, args.dpi)
+    print(f"共写入 {count} 页到 {args.out}")
@@ -0,0 +1,70 @@
+import time
+
+# 时间预算状态
+NORMAL = 'normal'          # 预算充足，正常推理
+DEGRADED = 'degraded'      # 预算紧张：跳过可选工具（裁剪等）、降低图像分辨率、缩短生成长度
+ANSWER_NOW = 'answer_now'  # 只够最后一次模型调用，要求模型立即回答
+
+
+class Deadline:
+    """一次运行的总时间预算（秒）
+
+    剩余时间作为超时传给每次模型调用、搜索和图片下载；同时根据观测到的每步耗时估计
+    还能走几步，预算紧张时降级，只剩一步的时间时强制回答。
+    answer_reserve 为留给最后一次回答的时间，实际取它和观测到的模型调用耗时中的较大值。
+    """
+
+    def __init__(self, budget, answer_reserve=3.0, degrade_steps=3, min_timeout=0.5):
+        self.budget = budget
+        self.expires = time.monotonic() + budget
+        self.answer_reserve = answer_reserve
+        self.degrade_steps = degrade_steps
+        self.min_timeout = min_timeout
+        self.model_latency = None
+        self.step_latency = None
+
+    @classmethod
+    def of(cls, deadline):
+        """run(deadline=...) 既可以传秒数，也可以传 Deadline 对象"""
+        if deadline is None or isinstance(deadline, Deadline):
+            return deadline
+        return cls(float(deadline))
+
+    @property
+    def remaining(self):
+        return self.expires - time.monotonic()
+
+    @property
+    def expired(self):
+        return self.remaining <= 0
+
+    def timeout(self, cap=None, reserve=0.0):
+        """可以分给下一次调用的超时：剩余时间减去 reserve，不超过 cap，不低于 min_timeout"""
+        left = self.remaining - reserve
+        if cap is not None:
+            left = min(left, cap)
+        return max(left, self.min_timeout)
+
+    @staticmethod
+    def _ewma(old, new, alpha=0.5):
+        return new if old is None else alpha * new + (1 - alpha) * old
+
+    def observe_model(self, elapsed):
+        self.model_latency = self._ewma(self.model_latency, elapsed)
+
+    def observe_step(self, elapsed):
+        self.step_latency = self._ewma(self.step_latency, elapsed)
+
+    @property
+    def reserve(self):
+        return max(self.answer_reserve, self.model_latency or 0.0)
+
+    def level(self):
+        """根据剩余时间和每步耗时估计给出当前的预算状态"""
+        spare = self.remaining - self.reserve
+        step = self.step_latency or self.reserve
+        if spare < step:
+            return ANSWER_NOW
+        if spare < self.degrade_steps * step:
+            return DEGRADED
+        return NORMAL
@@ -0,0 +1,104 @@
+import hashlib
+
+
+class ImageRef:
+    """事件中的图像句柄：引用 agent 已持有的图像（不复制），内容哈希和渲染都在消费者需要时才计算
+
+    bbox 不为空时表示在图像上标注该区域（如裁剪位置），只有调用 render 时才在副本上绘制，
+    无界面的批量调用方不会为每一步复制和绘图。
+    caption 为检索服务给出的图像标题和来源（语料库页面为页面文本），奖励计算把它作为检索证据。
+    """
+
+    __slots__ = ('image', 'bbox', 'outline', 'width', 'caption', '_digest')
+
+    def __init__(self, image, bbox=None, outline=(160, 32, 240), width=7, caption=''):
+        self.image = image
+        self.bbox = bbox
+        self.outline = outline
+        self.width = width
+        self.caption = caption
+        self._digest = None
+
+    @property
+    def size(self):
+        return self.image.size
+
+    @property
+    def digest(self):
+        """渲染结果的内容哈希：原图的像素哈希，带标注时再加上标注参数"""
+        if self._digest is None:
+            # blobstore 会导入 PIL，在需要哈希时才导入，保持 vrag 的冷启动开销
+            from blobstore import image_hash
+            digest = image_hash(self.image)
+            if self.bbox is not None:
+                overlay = f'{digest}:{list(self.bbox)}:{self.outline}:{self.width}'
+                digest = hashlib.sha1(overlay.encode()).hexdigest()
+            self._digest = digest
+        return self._digest
+
+    def render(self):
+        """返回可显示的 PIL 图像；带标注时在副本上绘制 bbox"""
+        if self.bbox is None:
+            return self.image
+        from PIL import ImageDraw
+
+        image = self.image.copy()
+        ImageDraw.Draw(image).rectangle(list(self.bbox), outline=self.outline, width=self.width)
+        return image
+
+    def __repr__(self):
+        width, height = self.image.size
+        overlay = '' if self.bbox is None else f', bbox={list(self.bbox)}'
+        return f'ImageRef({width}x{height}{overlay})'
+
+
+def render(value):
+    """把事件内容中的 ImageRef 渲染为 PIL 图像，其他值原样返回（列表和元组逐项处理）"""
+    if isinstance(value, ImageRef):
+        return value.render()
+    if isinstance(value, (list, tuple)):
+        return type(value)(render(v) for v in value)
+    return value
+
+
+class Event:
+    """run 产出的事件：think、search、search_image、crop_image、answer、delta 等
+
+    可以像 (action, content, raw_content) 元组一样解包、下标访问、比较和哈希（内容不可哈希时同样抛出 TypeError），
+    已有的消费者不需要修改。
+    图像以 ImageRef 传递，需要显示时调用 render（或 events.render）。
+    """
+
+    __slots__ = ('action', 'content', 'raw_content')
+
+    def __init__(self, action, content='', raw_content=''):
+        self.action = action
+        self.content = content
+        self.raw_content = raw_content
+
+    @classmethod
+    def of(cls, event):
+        """把 (action, content, raw_content) 元组转成 Event，已经是 Event 时原样返回"""
+        if isinstance(event, Event):
+            return event
+        return cls(*event)
+
+    def __iter__(self):
+        return iter((self.action, self.content, self.raw_content))
+
+    def __getitem__(self, index):
+        return (self.action, self.content, self.raw_content)[index]
+
+    def __len__(self):
+        return 3
+
+    def __eq__(self, other):
+        if isinstance(other, (Event, tuple)):
+            return tuple(self) == tuple(other)
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(tuple(self))
+
+    def __repr__(self):
+        return f'Event({self.action!r}, {self.content!r}, {self.raw_content!r})'
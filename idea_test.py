@@ -8,6 +8,8 @@ import numpy as np
 import requests
 from openai import OpenAI
 from unittest.mock import patch
+from reward import batch_reward
+from blobstore import MemoryBlobStore
 
 #提示词模版：定义多模态推理和工具调用格式
 prompt_ins='''Answer the given question step by step.
@@ -28,6 +30,8 @@ class MultimodalRLRAG:
         self.max_pixels=512*28*28
         self.min_pixels=256*28*28
         self.max_steps=10 #限制最大步骤
+        #检索到的图像只保存在内存blob store中
+        self.blobs=MemoryBlobStore()
         
     def process_image(self,image_path):
         """处理图像：调整尺寸并转为base64"""
@@ -68,21 +72,18 @@ class MultimodalRLRAG:
         return mock_data.get(query, [f"关于'{query}'的文本信息"])
     
     def search_visual(self,query):
-        """模拟图像搜索返回路径"""
+        """模拟图像搜索返回blob句柄"""
         print(f"[模拟图像搜索] 查询：{query}")
         #生成1张测试图像作为搜索结果
         img=Image.new("RGB",(300,300),color="green")
-        img_path=f"mock_{query}.jpg"
-        img.save(img_path)
-        return [img_path]
+        return [self.blobs.put(img)]
     
-    def calc_reward(self,pred_ans,gold_ans):
-        """计算奖励：评估答案质量（简化版）"""
-        pred_words=set(pred_ans.lower().split())
-        gold_words=set(gold_ans.lower().split())
-        #答案准确率作为奖励
-        accuracy=len(pred_words & gold_words)/max(len(gold_words),1)
-        return round(accuracy*10,2) #奖励范围0～10
+    def calc_reward(self,pred_ans,gold_ans,trajectory=None,multimodal_weight=0.3):
+        """计算奖励：评估答案质量（批量奖励引擎的单条版本，支持中文）"""
+        if trajectory is None:
+            multimodal_weight=0 #没有轨迹时不计对齐项，完全正确的答案得满分
+        rewards=batch_reward([pred_ans],[gold_ans],[trajectory],multimodal_weight=multimodal_weight)
+        return round(float(max(rewards['reward'][0],0))*10,2) #奖励范围0～10
     
     def run(self,question,gold_ans=""):
         """主流程：处理问题->调用工具->生成答案->计算奖励"""
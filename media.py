@@ -0,0 +1,99 @@
+import functools
+import hashlib
+import os
+import threading
+import uuid
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MediaStore:
+    """把发给模型的图像写入本地目录，消息中只传引用地址而不是内联 base64
+
+    文件按内容哈希命名，同一张图只写一次，多轮对话重复引用时请求体只有几十字节。
+    - base_url 为空时返回 file:// 地址，vLLM 需要以 --allowed-local-media-path <root> 启动，且与本进程共享文件系统；
+    - 否则返回 base_url/<文件名>，可配合 MediaServer 或任何静态文件服务使用。
+    文件数超过 max_files 时按修改时间删除最旧的文件（每 prune_every 次写入检查一次）。
+    """
+
+    def __init__(self, root, base_url=None, max_files=10000, prune_every=100):
+        self.root = os.path.abspath(root)
+        self.base_url = base_url.rstrip('/') if base_url else None
+        self.max_files = max_files
+        self.prune_every = prune_every
+        self.puts = 0
+        self.lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+
+    def put(self, data, ext='jpg'):
+        """保存图像字节并返回模型可加载的地址"""
+        name = f'{hashlib.sha1(data).hexdigest()}.{ext}'
+        path = os.path.join(self.root, name)
+        if not os.path.exists(path):
+            # 先写临时文件再改名，模型服务不会读到半个文件
+            tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        with self.lock:
+            self.puts += 1
+            prune = self.max_files is not None and self.puts % self.prune_every == 0
+        if prune:
+            self.prune()
+        if self.base_url is not None:
+            return f'{self.base_url}/{name}'
+        return f'file://{path}'
+
+    def prune(self):
+        """删除超出 max_files 的最旧文件"""
+        entries = []
+        for entry in os.scandir(self.root):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                entries.append((entry.stat().st_mtime, entry.path))
+        entries.sort()
+        for _, path in entries[:max(len(entries) - self.max_files, 0)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class MediaServer:
+    """在后台线程中提供 root 目录的只读 HTTP 服务，供无法访问本机文件系统的 vLLM 拉取图像"""
+
+    def __init__(self, root, host='127.0.0.1', port=0):
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+        handler = functools.partial(_QuietHandler, directory=self.root)
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+            self.thread.start()
+        return self.base_url
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def media_store(root, serve=False, host='127.0.0.1', port=0):
+    """创建 MediaStore；serve=True 时同时启动 MediaServer 并使用 http:// 地址"""
+    if not serve:
+        return MediaStore(root)
+    server = MediaServer(root, host, port)
+    store = MediaStore(root, base_url=server.start())
+    store.server = server
+    return store
@@ -0,0 +1,182 @@
+import gc
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager
+
+from admission import SchedulerSaturated
+
+
+class MemoryPressure(SchedulerSaturated):
+    """进程 RSS 超过上限且回收后仍未降下来，拒绝新的问题"""
+
+
+def rss_bytes():
+    """当前进程的常驻内存；没有 /proc 的平台退回 getrusage 的峰值"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def count_live_objects():
+    """统计存活的 PIL 图像和 base64 图像字符串的数量与字节数（遍历所有对象，开销较大）"""
+    from PIL import Image
+
+    images = image_bytes = 0
+    strings = string_bytes = 0
+    seen = set()
+    for obj in gc.get_objects():
+        if isinstance(obj, Image.Image):
+            images += 1
+            image_bytes += obj.width * obj.height * len(obj.getbands())
+            continue
+        # 字符串不被 gc 跟踪，从引用它们的字典和列表中查找；先复制，其他线程可能同时在修改
+        try:
+            if isinstance(obj, dict):
+                values = list(obj.values())
+            elif isinstance(obj, list):
+                values = list(obj)
+            else:
+                continue
+        except RuntimeError:
+            continue
+        for value in values:
+            if isinstance(value, str) and value.startswith('data:image') and id(value) not in seen:
+                seen.add(id(value))
+                strings += 1
+                string_bytes += len(value)
+    return {
+        'pil_images': images,
+        'pil_image_bytes': image_bytes,
+        'base64_strings': strings,
+        'base64_bytes': string_bytes,
+    }
+
+
+class MemoryProfiler:
+    """按问题做 tracemalloc 快照对比，报告本次运行后仍存活的分配最多的代码位置
+
+    第一次使用时启动 tracemalloc 并保持开启（停止会清空已跟踪的分配），会带来明显的性能开销，只在排查时开启。
+    多个问题并发运行时快照是全进程的，报告中会混入其他问题的分配。
+    path 不为空时每份报告追加写入该 jsonl 文件；最近 keep 份报告保存在 reports 中。
+    """
+
+    def __init__(self, top=10, frames=1, path=None, count_objects=True, keep=100):
+        self.top = top
+        self.frames = frames
+        self.path = path
+        self.count_objects = count_objects
+        self.reports = deque(maxlen=keep)
+        self.lock = threading.Lock()
+
+    def _snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap*>'),
+        ])
+
+    @contextmanager
+    def profile(self, label):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+        before = self._snapshot()
+        rss_before = rss_bytes()
+        started = time.perf_counter()
+        report = {'question': label}
+        try:
+            yield report
+        finally:
+            stats = self._snapshot().compare_to(before, 'lineno' if self.frames == 1 else 'traceback')
+            report.update({
+                'elapsed': round(time.perf_counter() - started, 3),
+                'rss_before': rss_before,
+                'rss_after': rss_bytes(),
+                'traced_delta': sum(s.size_diff for s in stats),
+                'top': [
+                    {'site': str(s.traceback), 'size_diff': s.size_diff, 'count_diff': s.count_diff}
+                    for s in stats[:self.top]
+                ],
+            })
+            if self.count_objects:
+                report['live'] = count_live_objects()
+            self._publish(report)
+
+    def _publish(self, report):
+        with self.lock:
+            self.reports.append(report)
+            if self.path is not None:
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(report, ensure_ascii=False) + '\n')
+        print(f"内存分析 [{report['question'][:40]}]: 跟踪分配净增 {report['traced_delta'] / 1024:.1f} KiB, "
+              f"RSS {report['rss_after'] / 2 ** 20:.1f} MiB")
+        for item in report['top'][:3]:
+            print(f"  {item['site']}: {item['size_diff'] / 1024:+.1f} KiB ({item['count_diff']:+d})")
+
+
+class MemoryWatchdog:
+    """RSS 看门狗：在每个问题开始前检查
+
+    超过 soft_ratio × max_rss 时依次调用回收函数（清理缓存等）并 gc；
+    回收后仍超过 max_rss 时抛出 MemoryPressure 拒绝新的问题，已在运行的问题不受影响。
+    """
+
+    def __init__(self, max_rss, evictors=(), soft_ratio=0.9):
+        self.max_rss = max_rss
+        self.soft_limit = max_rss * soft_ratio
+        self.evictors = list(evictors)
+        self.evictions = 0
+        self.refused = 0
+        self.lock = threading.Lock()
+
+    def add_evictor(self, fn):
+        self.evictors.append(fn)
+        return fn
+
+    def evict(self):
+        with self.lock:
+            self.evictions += 1
+            for fn in self.evictors:
+                try:
+                    fn()
+                except Exception as e:
+                    print(f"内存回收失败: {e}")
+            gc.collect()
+
+    def check(self):
+        rss = rss_bytes()
+        if rss < self.soft_limit:
+            return rss
+        self.evict()
+        rss = rss_bytes()
+        if rss >= self.max_rss:
+            self.refused += 1
+            raise MemoryPressure(f'内存占用过高（{rss / 2 ** 20:.0f} MiB），请稍后再试')
+        return rss
+
+    def stats(self):
+        return {
+            'rss': rss_bytes(),
+            'max_rss': self.max_rss,
+            'evictions': self.evictions,
+            'refused': self.refused,
+        }
+
+
+@contextmanager
+def run_guard(profiler=None, watchdog=None, label=''):
+    """一次运行的内存保护：先经过看门狗检查，再在开启分析时包住整个运行"""
+    if watchdog is not None:
+        watchdog.check()
+    if profiler is None:
+        yield None
+        return
+    with profiler.profile(label) as report:
+        yield report
@@ -0,0 +1,56 @@
+import re
+
+from step_scheduler import normalize_query
+
+# 改写时去掉的英文疑问词和虚词
+STOPWORDS = {
+    'what', 'which', 'who', 'whom', 'whose', 'when', 'where', 'why', 'how', 'is', 'are', 'was', 'were',
+    'do', 'does', 'did', 'can', 'could', 'the', 'a', 'an', 'of', 'in', 'on', 'at', 'for', 'to', 'by',
+    'about', 'please', 'tell', 'me', 'show', 'find', 'much', 'many', 'there', 'this', 'that',
+}
+# 中文疑问词和语气词
+CJK_FILLERS = re.compile(r'是多少|多少|是什么|什么|哪些|哪个|哪里|如何|怎么样|怎么|为什么|请问|吗|呢')
+# 复合问题的分句位置
+CLAUSE_SPLIT = re.compile(r'[,，;；。？?！!]|\band\b|以及|并且')
+
+
+def keywords(query):
+    """去掉疑问词、虚词和标点，只保留检索有用的关键词"""
+    query = CJK_FILLERS.sub(' ', str(query))
+    words = re.findall(r'[\w\-\.%]+', query)
+    words = [w for w in words if w.lower() not in STOPWORDS]
+    return ' '.join(words)
+
+
+def expand_query(query, max_queries=3):
+    """规则改写：原查询、关键词形式、复合问题拆出的各个子句（同样取关键词），去重后最多 max_queries 个"""
+    query = ' '.join(str(query[0] if isinstance(query, list) else query).split())
+    candidates = [query, keywords(query)]
+    clauses = [c for c in CLAUSE_SPLIT.split(query) if c and c.strip()]
+    if len(clauses) > 1:
+        candidates.extend(keywords(c) for c in clauses)
+
+    queries, seen = [], set()
+    for candidate in candidates:
+        key = normalize_query(candidate)
+        if key and key not in seen:
+            seen.add(key)
+            queries.append(candidate)
+        if len(queries) >= max_queries:
+            break
+    return queries
+
+
+def reciprocal_rank_fusion(result_lists, key=lambda item: item, k=60):
+    """倒数排名融合（RRF）：每个结果得分为其在各列表中 1 / (k + 排名) 之和，按得分从高到低返回
+
+    key 用于判断不同列表中的结果是否相同，相同结果保留第一次出现的对象。
+    """
+    scores, items = {}, {}
+    for results in result_lists:
+        for rank, item in enumerate(results):
+            item_key = key(item)
+            scores[item_key] = scores.get(item_key, 0.0) + 1.0 / (k + rank + 1)
+            items.setdefault(item_key, item)
+    # 得分相同时按首次出现的顺序（dict 保持插入顺序，sorted 是稳定排序）
+    return [items[item_key] for item_key in sorted(scores, key=lambda x: -scores[x])]
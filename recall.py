@@ -0,0 +1,118 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+from blobstore import image_hash
+from step_scheduler import normalize_query
+
+# 各类检索结果默认保留的条数
+DEFAULT_CAPACITY = {'text': 512, 'table': 128, 'image': 64}
+
+
+def content_key(kind, value):
+    """按内容计算去重键：图像用像素哈希，文本用 sha1"""
+    if kind == 'image':
+        return image_hash(value)
+    return hashlib.sha1(str(value).encode('utf-8')).hexdigest()
+
+
+class _Entry:
+    __slots__ = ('kind', 'value', 'queries')
+
+    def __init__(self, kind, value):
+        self.kind = kind
+        self.value = value
+        self.queries = set()
+
+
+class RecallStore:
+    """会话级的检索结果存储：按内容哈希去重、按类别限制条数并 LRU 淘汰，按（类别, 归一化查询）建立索引
+
+    同一会话中后续问题再次检索相同查询时可以直接从这里取回文本、表格和图像，不再调用检索服务。
+    图像条目可以通过 blobstore.BlobHandle(key, store) 引用（实现了 get）。
+    """
+
+    def __init__(self, capacity=None):
+        self.capacity = dict(DEFAULT_CAPACITY, **(capacity or {}))
+        self.kinds = {kind: OrderedDict() for kind in self.capacity}
+        self.keys = {}
+        self.by_query = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def add(self, kind, query, value, key=None):
+        """保存一条检索结果并记入 query 的索引，返回内容键；已存在时只更新索引和 LRU 顺序"""
+        key = key or content_key(kind, value)
+        query_key = (kind, normalize_query(query))
+        with self.lock:
+            entries = self.kinds[kind]
+            entry = entries.get(key)
+            if entry is None:
+                entry = entries[key] = _Entry(kind, value)
+                self.keys[key] = kind
+            else:
+                entries.move_to_end(key)
+            if query_key not in entry.queries:
+                entry.queries.add(query_key)
+                self.by_query.setdefault(query_key, []).append(key)
+            while len(entries) > self.capacity[kind]:
+                self._evict(entries)
+        return key
+
+    def _evict(self, entries):
+        key, entry = entries.popitem(last=False)
+        del self.keys[key]
+        for query_key in entry.queries:
+            keys = self.by_query.get(query_key)
+            if keys is None:
+                continue
+            keys.remove(key)
+            if not keys:
+                del self.by_query[query_key]
+        self.evictions += 1
+
+    def lookup(self, kind, query):
+        """返回之前为相同（归一化后）查询保存的结果，按保存顺序；没有时返回空列表"""
+        with self.lock:
+            keys = self.by_query.get((kind, normalize_query(query)))
+            if not keys:
+                self.misses += 1
+                return []
+            self.hits += 1
+            entries = self.kinds[kind]
+            for key in keys:
+                entries.move_to_end(key)
+            return [(key, entries[key].value) for key in keys]
+
+    def get(self, key):
+        with self.lock:
+            kind = self.keys.get(key)
+            if kind is None:
+                raise KeyError(f'检索结果不存在或已被淘汰: {key}')
+            entries = self.kinds[kind]
+            entries.move_to_end(key)
+            return entries[key].value
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    def clear(self):
+        with self.lock:
+            for entries in self.kinds.values():
+                entries.clear()
+            self.keys.clear()
+            self.by_query.clear()
+
+    def stats(self):
+        return {
+            'items': {kind: len(entries) for kind, entries in self.kinds.items()},
+            'queries': len(self.by_query),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
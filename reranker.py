@@ -0,0 +1,115 @@
+import os
+import re
+import zlib
+
+import numpy as np
+
+from reward import tokenize
+
+
+class HashingEmbedder:
+    """无需模型文件的文本向量：词和相邻词对按哈希映射到固定维度，带符号以减少冲突偏差
+
+    中文按字切分（与 reward.tokenize 相同），字对相当于词，适合标题、摘要这类短文本。
+    """
+
+    def __init__(self, dim=1024):
+        self.dim = dim
+
+    def _features(self, text):
+        tokens = tokenize(text)
+        return tokens + [f'{a} {b}' for a, b in zip(tokens, tokens[1:])]
+
+    def embed(self, texts):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for feature in self._features(text):
+                h = zlib.crc32(feature.encode('utf-8'))
+                vectors[i, h % self.dim] += 1.0 if (h >> 31) & 1 else -1.0
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-8)
+
+
+class OnnxEmbedder:
+    """ONNX 句向量模型（如导出的 MiniLM / bge-small），在 CPU 上批量推理，按 attention mask 做均值池化
+
+    需要 onnxruntime 和 tokenizers，只在构造时导入。
+    """
+
+    def __init__(self, model_path, tokenizer_path, max_length=128):
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        self.session = onnxruntime.InferenceSession(model_path, providers=['CPUExecutionProvider'])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.tokenizer = Tokenizer.from_file(tokenizer_path)
+        self.tokenizer.enable_truncation(max_length)
+        self.tokenizer.enable_padding()
+
+    def embed(self, texts):
+        encodings = self.tokenizer.encode_batch([str(t) for t in texts])
+        inputs = {
+            'input_ids': np.array([e.ids for e in encodings], dtype=np.int64),
+            'attention_mask': np.array([e.attention_mask for e in encodings], dtype=np.int64),
+            'token_type_ids': np.array([e.type_ids for e in encodings], dtype=np.int64),
+        }
+        hidden = self.session.run(None, {k: v for k, v in inputs.items() if k in self.input_names})[0]
+        mask = inputs['attention_mask'][..., None].astype(np.float32)
+        vectors = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-8)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-8)
+
+
+def candidate_text(candidate):
+    """候选的可比较文本：检索结果的标题和来源；只有地址时用地址中的词"""
+    if isinstance(candidate, dict):
+        return ' '.join(str(candidate.get(k) or '') for k in ('title', 'source'))
+    return ' '.join(re.split(r'[^0-9A-Za-z一-鿿]+', str(candidate)))
+
+
+class Reranker:
+    """在 CPU 上一次批量计算查询与所有候选的相似度，选出真正发给模型的图像或文本
+
+    图像候选的得分 = 标题/来源与查询的余弦相似度
+                   - position_weight × 原始排名比例（保留搜索引擎排序作为先验）
+                   - size_weight × 分辨率不足 min_pixels 的比例（过小的图裁剪后也看不清）
+    """
+
+    def __init__(self, embedder=None, position_weight=0.1, size_weight=0.2, min_pixels=256 * 28 * 28):
+        self.embedder = embedder or HashingEmbedder()
+        self.position_weight = position_weight
+        self.size_weight = size_weight
+        self.min_pixels = min_pixels
+
+    def similarity(self, query, texts):
+        if not texts:
+            return np.zeros(0, dtype=np.float32)
+        vectors = self.embedder.embed([query] + list(texts))
+        return vectors[1:] @ vectors[0]
+
+    def score_images(self, query, candidates, images, positions=None):
+        """candidates 为检索结果，images 为对应的已加载图像，positions 为候选在原始结果中的排名"""
+        scores = self.similarity(query, [candidate_text(c) for c in candidates])
+        n = len(candidates)
+        positions = np.arange(n) if positions is None else np.asarray(positions, dtype=np.float32)
+        scores = scores - self.position_weight * positions / max(n, 1)
+        pixels = np.array([image.width * image.height for image in images], dtype=np.float32)
+        shortfall = np.clip(1.0 - pixels / self.min_pixels, 0.0, 1.0)
+        return scores - self.size_weight * shortfall
+
+    def rank_texts(self, query, texts):
+        """按与查询的相似度从高到低返回文本下标，相同得分保持原始顺序"""
+        scores = self.similarity(query, texts)
+        return np.argsort(-scores, kind='stable').tolist()
+
+
+def default_reranker():
+    """设置 RERANK_ONNX_MODEL 和 RERANK_ONNX_TOKENIZER 时使用 ONNX 句向量模型，否则使用哈希向量"""
+    model_path = os.getenv('RERANK_ONNX_MODEL')
+    tokenizer_path = os.getenv('RERANK_ONNX_TOKENIZER')
+    if model_path and tokenizer_path:
+        try:
+            return Reranker(OnnxEmbedder(model_path, tokenizer_path))
+        except Exception as e:
+            print(f"ONNX 重排模型加载失败，改用哈希向量: {e}")
+    return Reranker()
@@ -0,0 +1,70 @@
+# 图像在轨迹中的用途
+FIRST_VIEW = 'search'  # 检索结果的第一眼
+CROP = 'crop'          # <bbox> 放大查看的区域
+PAGE = 'page'          # 文档页面（语料库），按文字密集处理
+
+
+class PixelBudget:
+    """一条轨迹内的像素分配：记录已发送的像素数，超出总预算后只给下限"""
+
+    def __init__(self, policy):
+        self.policy = policy
+        self.used = 0
+        self.history = []
+
+    @property
+    def remaining(self):
+        return max(self.policy.budget - self.used, 0)
+
+    def allocate(self, kind, image, min_pixels, cap=None):
+        """返回这张图的 max_pixels，并按实际会发送的像素数扣减预算
+
+        cap 为额外上限（如截止时间紧张时的降级分辨率）。
+        """
+        policy = self.policy
+        if kind == CROP:
+            want = policy.crop
+        elif kind == PAGE or policy.is_dense(image):
+            want = policy.dense_view
+        else:
+            want = policy.first_view
+        if cap is not None:
+            want = min(want, cap)
+        max_pixels = max(min(want, self.remaining), min_pixels)
+        sent = max(min(image.width * image.height, max_pixels), min_pixels)
+        self.used += sent
+        self.history.append((kind, max_pixels, sent))
+        return max_pixels
+
+
+class ResolutionPolicy:
+    """按图像在轨迹中的用途分配分辨率
+
+    - 检索结果第一眼用低分辨率（first_view），节省视觉 token 和 prefill 时间；
+    - 图表、表格、截图等文字密集的图像和文档页面用 dense_view，小字仍可辨认；
+    - <bbox> 裁剪区域用 crop，模型正是为了看清细节才裁剪；
+    整条轨迹发送的像素总数不超过 budget，超出后每张图只给 min_pixels。
+    文字密集的判断基于缩略图的边缘强度均值（dense_threshold），不需要模型。
+    """
+
+    def __init__(self, first_view=256 * 28 * 28, dense_view=512 * 28 * 28, crop=1024 * 28 * 28,
+                 budget=3072 * 28 * 28, dense_threshold=18.0):
+        self.first_view = first_view
+        self.dense_view = dense_view
+        self.crop = crop
+        self.budget = budget
+        self.dense_threshold = dense_threshold
+
+    def is_dense(self, image):
+        from PIL import ImageFilter, ImageStat
+
+        # 先整数倍缩小再转灰度，避免在原图上做滤波；调色板、1 位和 16 位图像不支持 reduce，先转灰度
+        if image.mode not in ('L', 'RGB', 'RGBA'):
+            image = image.convert('L')
+        thumb = image.reduce(max(max(image.size) // 256, 1)).convert('L')
+        edges = thumb.filter(ImageFilter.FIND_EDGES)
+        return ImageStat.Stat(edges).mean[0] >= self.dense_threshold
+
+    def start(self):
+        """为一条新轨迹创建像素预算"""
+        return PixelBudget(self)
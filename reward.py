@@ -0,0 +1,145 @@
+import re
+
+import numpy as np
+
+# 中日韩字符逐字切分，其余按字母数字串切分
+TOKEN_PATTERN = re.compile(r'[㐀-䶿一-鿿豈-﫿぀-ヿ가-힯]|[a-z0-9]+')
+
+
+def tokenize(text):
+    """CJK感知的分词：中文等按字切分，英文和数字按词切分"""
+    if not text:
+        return []
+    return TOKEN_PATTERN.findall(str(text).lower())
+
+
+class _Encoder:
+    """把一批文本编码成连续的 token id 数组，并记录每个 token 所属的样本"""
+
+    def __init__(self):
+        self.vocab = {}
+
+    def encode(self, texts):
+        ids, segments = [], []
+        for i, text in enumerate(texts):
+            tokens = [self.vocab.setdefault(t, len(self.vocab)) for t in tokenize(text)]
+            ids.extend(tokens)
+            segments.extend([i] * len(tokens))
+        return np.asarray(ids, dtype=np.int64), np.asarray(segments, dtype=np.int64)
+
+
+def _ngrams(ids, segments, n, vocab_size):
+    """向量化生成 n-gram：把相邻 n 个 id 组合成一个整数，跨样本边界的组合被丢弃"""
+    if len(ids) < n:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    grams = ids[:len(ids) - n + 1].copy()
+    valid = np.ones(len(grams), dtype=bool)
+    for k in range(1, n):
+        grams = grams * vocab_size + ids[k:len(ids) - n + 1 + k]
+        valid &= segments[k:len(ids) - n + 1 + k] == segments[:len(ids) - n + 1]
+    return grams[valid], segments[:len(ids) - n + 1][valid]
+
+
+def _counts(grams, segments, vocab_size, n):
+    """按 (样本, n-gram) 统计出现次数，返回唯一键和计数"""
+    keys = segments * (vocab_size ** n) + grams
+    return np.unique(keys, return_counts=True)
+
+
+def _overlap(pred_texts, ref_texts, max_n=2):
+    """一次性计算整批 (预测, 参考) 的 n-gram 重叠，返回 precision、recall 两个数组"""
+    size = len(pred_texts)
+    encoder = _Encoder()
+    pred_ids, pred_seg = encoder.encode(pred_texts)
+    ref_ids, ref_seg = encoder.encode(ref_texts)
+    # 词表大小取上界，保证 n-gram 组合成的整数互不冲突
+    vocab_size = max(len(encoder.vocab), 1)
+
+    precision = np.zeros(size)
+    recall = np.zeros(size)
+    # 只对长度足够产生该阶 n-gram 的样本计入平均，避免短答案被高阶 n-gram 拉低
+    pred_orders = np.zeros(size)
+    ref_orders = np.zeros(size)
+    for n in range(1, max_n + 1):
+        if (size * vocab_size ** n) >= 2 ** 62:
+            break
+        pred_grams, pred_gseg = _ngrams(pred_ids, pred_seg, n, vocab_size)
+        ref_grams, ref_gseg = _ngrams(ref_ids, ref_seg, n, vocab_size)
+        pred_keys, pred_counts = _counts(pred_grams, pred_gseg, vocab_size, n)
+        ref_keys, ref_counts = _counts(ref_grams, ref_gseg, vocab_size, n)
+
+        _, pi, ri = np.intersect1d(pred_keys, ref_keys, assume_unique=True, return_indices=True)
+        matched = np.minimum(pred_counts[pi], ref_counts[ri])
+        matched = np.bincount(pred_keys[pi] // (vocab_size ** n), weights=matched, minlength=size)
+        pred_total = np.bincount(pred_gseg, minlength=size)
+        ref_total = np.bincount(ref_gseg, minlength=size)
+
+        precision += np.divide(matched, pred_total, out=np.zeros(size), where=pred_total > 0)
+        recall += np.divide(matched, ref_total, out=np.zeros(size), where=ref_total > 0)
+        pred_orders += pred_total > 0
+        ref_orders += ref_total > 0
+    precision = np.divide(precision, pred_orders, out=np.zeros(size), where=pred_orders > 0)
+    recall = np.divide(recall, ref_orders, out=np.zeros(size), where=ref_orders > 0)
+    return precision, recall
+
+
+def trajectory_features(trajectories):
+    """从 (action, content, raw_content) 事件序列中统计步数、图像检索次数、检索到的图像数和文本证据
+
+    证据只来自检索服务返回的内容（文本、表格结果和检索图像的标题/来源），不包含模型自己的思考和查询，
+    避免复述推理过程即可获得对齐分。
+    """
+    steps, searches, images, evidence = [], [], [], []
+    for trajectory in trajectories:
+        n_steps = n_searches = n_images = 0
+        texts = []
+        for action, content, raw_content in trajectory or []:
+            if action == 'think':
+                n_steps += 1
+            elif action == 'search':
+                # 图像检索请求，之后应跟一个 search_image 事件
+                n_searches += 1
+            elif action in ('search_text', 'search_table'):
+                # 文本/表格检索事件本身携带结果
+                texts.append(content if isinstance(content, str) else ' '.join(map(str, content)))
+            elif action in ('search_image', 'search_visual'):
+                n_images += 1
+                texts.append(getattr(content, 'caption', None))
+        steps.append(n_steps)
+        searches.append(n_searches)
+        images.append(n_images)
+        evidence.append(' '.join(t for t in texts if isinstance(t, str)))
+    return np.asarray(steps), np.asarray(searches), np.asarray(images), evidence
+
+
+def batch_reward(predictions, golds, trajectories=None, multimodal_weight=0.3,
+                 step_penalty=0.02, free_steps=2, retrieval_penalty=0.05, max_n=2):
+    """批量计算 RL 奖励，取值大致在 [0, 1]
+
+    reward = (1 - w) * accuracy + w * alignment - step_penalty * 超出免费步数的步数
+             - retrieval_penalty * 未带回图像的检索次数
+    accuracy 为预测与标准答案的 n-gram F1；alignment 为答案 n-gram 在检索到的文本证据中的命中率，
+    只有轨迹中确实检索到图像时才计入（多模态对齐项）。
+    没有轨迹（None）或轨迹中没有任何文本证据的样本无法计算对齐，w 按 0 处理，完全正确的答案仍得 1 分。
+    """
+    size = len(predictions)
+    precision, recall = _overlap(predictions, golds, max_n)
+    accuracy = np.divide(2 * precision * recall, precision + recall,
+                         out=np.zeros(size), where=(precision + recall) > 0)
+
+    if trajectories is None:
+        trajectories = [None] * size
+    steps, searches, images, evidence = trajectory_features(trajectories)
+    weight = multimodal_weight * np.asarray([bool(text.strip()) for text in evidence], dtype=float)
+    grounded, _ = _overlap(predictions, evidence, max_n)
+    alignment = grounded * (images > 0)
+
+    penalty = step_penalty * np.maximum(steps - free_steps, 0) + retrieval_penalty * np.maximum(searches - images, 0)
+    reward = (1 - weight) * accuracy + weight * alignment - penalty
+    return {
+        'reward': reward,
+        'accuracy': accuracy,
+        'alignment': alignment,
+        'penalty': penalty,
+        'steps': steps,
+    }
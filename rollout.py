@@ -0,0 +1,136 @@
+import copy
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import numpy as np
+
+from admission import BATCH
+from reward import batch_reward
+from step_scheduler import normalize_query
+from vrag import VRAG
+
+
+class _SharedTools:
+    """同一组 rollout 共享的工具调用缓存：相同查询只检索一次，相同 URL 只下载一次"""
+
+    def __init__(self, agent):
+        self.agent = agent
+        self.results = {}
+        self.key_locks = {}
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.saved = 0
+
+    def _cached(self, key, fn):
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            if key in self.results:
+                self.saved += 1
+                return self.results[key]
+            self.calls += 1
+            self.results[key] = fn()
+            return self.results[key]
+
+    def search(self, query, timeout=10):
+        return self._cached(('search', normalize_query(query)), lambda: self.agent.search(query, timeout=timeout))
+
+    def fetch_image(self, image_path):
+        return self._cached(('image', image_path), lambda: self.agent.fetch_image(image_path))
+
+
+class GroupedRollout:
+    """GRPO 式分组采样：同一问题从共享前缀分叉出 n 条轨迹
+
+    - 第一步用一次 n=N 的请求得到 N 个分支，之后各分支并行请求同一个副本，
+      共享的提示词前缀命中 vLLM 的前缀缓存
+    - 各分支中相同的检索和图像下载只执行一次
+    - 返回列式 batch，每列长度为 N，并附带批量计算的奖励
+    """
+
+    def __init__(self, agent=None, n=8, temperature=1.0, max_workers=None, multimodal_weight=0.3):
+        self.agent = agent or VRAG(generator=True)
+        self.n = n
+        self.temperature = temperature
+        self.max_workers = max_workers or n
+        self.multimodal_weight = multimodal_weight
+
+    def _branch(self, session, tools, first_response):
+        """复制出一个分支 agent：共享副本会话和工具缓存，第一步直接使用分叉得到的回复"""
+        branch = copy.copy(self.agent)
+        branch.session = session
+        branch.priority = BATCH
+        branch.recorder = None
+        branch.generator = True
+        branch.stream = False
+        branch.search = tools.search
+        branch.fetch_image = tools.fetch_image
+        pending = [first_response]
+
+        def chat(messages, **kwargs):
+            if pending:
+                return pending.pop()
+            return VRAG._chat(branch, messages, temperature=self.temperature, **kwargs)
+
+        branch._chat = chat
+        return branch
+
+    def _run_branch(self, branch, question):
+        trajectory, answer = [], ''
+        try:
+            for event in branch._run(question):
+                trajectory.append(event)
+                if event[0] == 'answer':
+                    answer = event[1]
+        except Exception as e:
+            trajectory.append(('error', repr(e), ''))
+        return answer, trajectory
+
+    def run(self, question, gold_ans=''):
+        agent = self.agent
+        with agent.scheduler.admit(BATCH), agent.router.session() as session:
+            agent.session = session
+            agent.priority = BATCH
+            agent.deadline = None
+            agent.degraded = False
+            # 共享前缀只做一次 prefill，n 个分支从同一个 KV 缓存分叉
+            forked = agent._chat(agent.initial_messages(question), n=self.n, temperature=self.temperature)
+            tools = _SharedTools(agent)
+            branches = [
+                self._branch(session, tools, SimpleNamespace(choices=[choice]))
+                for choice in forked.choices
+            ]
+            with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                results = list(pool.map(lambda b: self._run_branch(b, question), branches))
+
+        answers = [answer for answer, _ in results]
+        trajectories = [trajectory for _, trajectory in results]
+        rewards = batch_reward(
+            answers, [gold_ans] * len(answers), trajectories,
+            multimodal_weight=self.multimodal_weight
+        )
+        batch = {
+            'question': [question] * len(answers),
+            'branch': np.arange(len(answers)),
+            'answer': answers,
+            'trajectory': trajectories,
+            'tool_calls': np.full(len(answers), tools.calls),
+            'tool_calls_saved': np.full(len(answers), tools.saved),
+        }
+        batch.update(rewards)
+        return batch
+
+    def run_batch(self, questions, gold_answers):
+        """多个问题依次分组采样，结果按列拼接"""
+        batches = [self.run(q, g) for q, g in zip(questions, gold_answers)]
+        if not batches:
+            return {}
+        merged = {}
+        for key in batches[0]:
+            values = [b[key] for b in batches]
+            if isinstance(values[0], np.ndarray):
+                merged[key] = np.concatenate(values)
+            else:
+                merged[key] = [v for value in values for v in value]
+        return merged
@@ -0,0 +1,174 @@
+import threading
+import time
+from contextlib import contextmanager
+
+
+
+class NoHealthyReplica(Exception):
+    """所有模型副本都不可用"""
+
+
+class Replica:
+    """一个 OpenAI 兼容的模型服务端点"""
+
+    def __init__(self, base_url, api_key='EMPTY'):
+        self.base_url = base_url
+        self.api_key = api_key
+        self._client = None
+        self.outstanding = 0  # 正在进行的请求数
+        self.sessions = 0     # 绑定在该副本上的问题数
+        self.healthy = True
+        self.checked_at = 0.0
+        self.models = []
+
+    @property
+    def client(self):
+        """OpenAI 客户端在首次使用时才创建（openai 的导入较重）"""
+        if self._client is None:
+            from openai import OpenAI
+            self._client = OpenAI(base_url=self.base_url, api_key=self.api_key)
+        return self._client
+
+    @client.setter
+    def client(self, client):
+        self._client = client
+
+    def __repr__(self):
+        return f'Replica({self.base_url}, outstanding={self.outstanding}, sessions={self.sessions}, healthy={self.healthy})'
+
+
+class RouterSession:
+    """一个问题的会话：所有步骤固定在同一副本上，让该副本的前缀缓存覆盖不断增长的消息历史"""
+
+    def __init__(self, router, replica):
+        self.router = router
+        self.replica = replica
+
+    @contextmanager
+    def request(self):
+        """包住一次模型调用，统计在途请求；连接失败时标记副本不健康
+
+        超时（APITimeoutError，APIConnectionError 的子类）不标记：截止时间让单次调用超时是常态，副本本身可能是健康的。
+        """
+        replica = self.replica
+        with self.router.lock:
+            replica.outstanding += 1
+        try:
+            yield replica.client
+        except Exception as e:
+            from openai import APIConnectionError, APITimeoutError
+            if isinstance(e, APIConnectionError) and not isinstance(e, APITimeoutError):
+                self.router.mark_unhealthy(replica)
+            raise
+        finally:
+            with self.router.lock:
+                replica.outstanding -= 1
+
+    def failover(self):
+        """当前副本失效时迁移到另一个副本（前缀缓存需要重新建立）"""
+        old = self.replica
+        new = self.router.pick(exclude=(old,), bind=True)
+        with self.router.lock:
+            old.sessions -= 1
+        self.replica = new
+        return new
+
+
+class ReplicaRouter:
+    """客户端负载均衡：健康检查 + 最少在途请求选择 + 按问题的会话亲和"""
+
+    def __init__(self, base_urls, api_key='EMPTY', health_interval=30, probe_timeout=2):
+        if isinstance(base_urls, str):
+            base_urls = [base_urls]
+        self.replicas = [Replica(url, api_key) for url in base_urls]
+        self.health_interval = health_interval
+        self.probe_timeout = probe_timeout
+        self.lock = threading.Lock()
+        self.refreshing = False
+
+    def probe(self, replica):
+        """用 models.list 探测副本是否可用（与 chat.py 中的检查方式相同）"""
+        try:
+            models = replica.client.with_options(timeout=self.probe_timeout, max_retries=0).models.list()
+            replica.models = [m.id for m in models.data]
+            replica.healthy = True
+        except Exception as e:
+            print(f"副本不可用 {replica.base_url}: {e}")
+            replica.healthy = False
+        replica.checked_at = time.monotonic()
+        return replica.healthy
+
+    def check_health(self, force=False):
+        """探测超过检查间隔的副本；单副本时不探测，直接使用"""
+        if len(self.replicas) == 1 and not force:
+            return
+        now = time.monotonic()
+        for replica in self.replicas:
+            if force or now - replica.checked_at >= self.health_interval:
+                self.probe(replica)
+
+    def refresh_stale(self):
+        """有副本超过检查间隔时在后台线程中探测，同一时刻只有一个刷新线程
+
+        调用方不等待探测结果，直接使用缓存的健康状态，问题开始时不会因探测而阻塞。
+        """
+        if len(self.replicas) == 1:
+            return
+        now = time.monotonic()
+        with self.lock:
+            if self.refreshing or all(now - r.checked_at < self.health_interval for r in self.replicas):
+                return
+            self.refreshing = True
+
+        def refresh():
+            try:
+                self.check_health()
+            finally:
+                self.refreshing = False
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def mark_unhealthy(self, replica):
+        replica.healthy = False
+        replica.checked_at = time.monotonic()
+
+    def pick(self, exclude=(), bind=False):
+        """选择在途请求最少（其次绑定问题最少）的健康副本
+
+        bind=True 时在同一把锁内把问题绑定到选中的副本，并发开始的问题不会都选中同一个副本。
+        """
+        self.refresh_stale()
+        candidates = [r for r in self.replicas if r.healthy and r not in exclude]
+        if not candidates:
+            # 全部不健康时同步强制重新探测一次，仍不可用则报错
+            self.check_health(force=True)
+            candidates = [r for r in self.replicas if r.healthy and r not in exclude]
+        if not candidates:
+            raise NoHealthyReplica('没有可用的模型副本')
+        with self.lock:
+            replica = min(candidates, key=lambda r: (r.outstanding, r.sessions))
+            if bind:
+                replica.sessions += 1
+            return replica
+
+    @contextmanager
+    def session(self):
+        """为一个问题绑定副本，问题结束时释放"""
+        session = RouterSession(self, self.pick(bind=True))
+        try:
+            yield session
+        finally:
+            with self.lock:
+                session.replica.sessions -= 1
+
+    def stats(self):
+        return [
+            {
+                'base_url': r.base_url,
+                'healthy': r.healthy,
+                'outstanding': r.outstanding,
+                'sessions': r.sessions,
+            }
+            for r in self.replicas
+        ]
+
@@ -0,0 +1,318 @@
+import argparse
+import copy
+import json
+import os
+import queue
+import select
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+from admission import INTERACTIVE, BATCH, SchedulerSaturated
+from cancel import CancelToken, Cancelled
+from events import ImageRef
+
+
+class AgentPool:
+    """固定数量的 agent 副本，每个同时只处理一个问题
+
+    副本由 copy.copy 得到，共享模型副本路由、准入调度器、工具注册表和连接池，
+    只有每次运行的状态（图像、消息等）相互独立。空闲副本用完时请求排队，
+    排队数超过 max_queue 或等待超过 queue_timeout 时拒绝。
+    """
+
+    def __init__(self, agent, size=4, max_queue=16, queue_timeout=30):
+        self.size = size
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.agents = [agent] + [copy.copy(agent) for _ in range(size - 1)]
+        self.idle = queue.Queue()
+        for a in self.agents:
+            self.idle.put(a)
+        self.lock = threading.Lock()
+        self.waiting = 0
+        self.served = 0
+        self.rejected = 0
+        self.cancelled = 0
+        self.errors = 0
+
+    @contextmanager
+    def acquire(self):
+        with self.lock:
+            if self.waiting >= self.max_queue:
+                self.rejected += 1
+                raise SchedulerSaturated('系统繁忙，请稍后再试')
+            self.waiting += 1
+        try:
+            agent = self.idle.get(timeout=self.queue_timeout)
+        except queue.Empty:
+            with self.lock:
+                self.rejected += 1
+            raise SchedulerSaturated('排队超时，请稍后再试')
+        finally:
+            with self.lock:
+                self.waiting -= 1
+        try:
+            yield agent
+        finally:
+            self.idle.put(agent)
+
+    def count(self, field):
+        with self.lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+    def stats(self):
+        agent = self.agents[0]
+        return {
+            'workers': self.size,
+            'busy': self.size - self.idle.qsize(),
+            'queued': self.waiting,
+            'served': self.served,
+            'rejected': self.rejected,
+            'cancelled': self.cancelled,
+            'errors': self.errors,
+            'admission': agent.scheduler.stats(),
+            'replicas': agent.router.stats(),
+            'tools': agent.tools.report(),
+            'single_flight': agent.flights.stats(),
+            'memory': None if agent.watchdog is None else agent.watchdog.stats(),
+        }
+
+
+def encode_value(value, images=True):
+    """把事件内容转成可 JSON 序列化的值：PIL 图像和 ImageRef 编码为 JPEG data URL（images=False 时为 None）
+
+    images=False 时 ImageRef 不会被渲染，裁剪标注也不会绘制。
+    """
+    if isinstance(value, ImageRef):
+        return encode_value(value.render(), images) if images else None
+    if hasattr(value, 'save') and hasattr(value, 'size'):
+        if not images:
+            return None
+        from vrag import jpeg_data_url
+        buf = BytesIO()
+        (value if value.mode == 'RGB' else value.convert('RGB')).save(buf, format='JPEG')
+        return jpeg_data_url(buf.getvalue())
+    if isinstance(value, (list, tuple)):
+        return [encode_value(v, images) for v in value]
+    return value
+
+
+def request_error(request):
+    """检查请求体各字段，返回错误描述；合法时返回 None"""
+    if not isinstance(request, dict) or not isinstance(request.get('question'), str):
+        return 'request body must be JSON with a "question" field'
+    max_steps = request.get('max_steps')
+    if max_steps is not None and (type(max_steps) is not int or max_steps <= 0):
+        return '"max_steps" must be a positive integer'
+    deadline = request.get('deadline')
+    if deadline is not None and (type(deadline) not in (int, float) or not 0 < deadline < float('inf')):
+        return '"deadline" must be a positive number of seconds'
+    if request.get('priority') not in (None, 'interactive', 'batch'):
+        return '"priority" must be "interactive" or "batch"'
+    return None
+
+
+class VRAGHandler(BaseHTTPRequestHandler):
+    """POST /run 以 server-sent events 流式返回 think/search/crop/answer 等事件
+
+    请求体：{"question": ..., "max_steps": 可选, "deadline": 可选秒数, "priority": "interactive"|"batch",
+            "deltas": 是否推送模型增量（默认 true）, "images": 是否内联图像（默认 true）}
+    GET /metrics 返回工作副本、排队和各后端的统计；GET /healthz 用于负载均衡健康检查。
+    """
+
+    server_version = 'VRAG/1.0'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_event(self, name, payload):
+        data = json.dumps(payload, ensure_ascii=False)
+        self.wfile.write(f'event: {name}\ndata: {data}\n\n'.encode('utf-8'))
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path == '/healthz':
+            self._send_json(200, {'status': 'ok'})
+        elif self.path == '/metrics':
+            self._send_json(200, self.server.pool.stats())
+        else:
+            self._send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if self.path != '/run':
+            self._send_json(404, {'error': 'not found'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            request = None
+        error = request_error(request)
+        if error is not None:
+            self._send_json(400, {'error': error})
+            return
+        question = request['question']
+
+        pool = self.server.pool
+        try:
+            with pool.acquire() as agent:
+                self._stream(agent, question, request)
+        except SchedulerSaturated as e:
+            self._send_json(503, {'error': str(e)})
+
+    def _watch_disconnect(self, cancel, finished):
+        """后台检查客户端连接，对端关闭后立即取消运行，不必等到下一次写事件时才发现"""
+        sock = self.connection
+        while not finished.wait(self.server.disconnect_poll):
+            try:
+                readable, _, _ = select.select([sock], [], [], 0)
+                if readable and not sock.recv(1, socket.MSG_PEEK):
+                    cancel.cancel('client disconnected')
+                    return
+            except (OSError, ValueError):
+                cancel.cancel('client disconnected')
+                return
+
+    def _stream(self, agent, question, request):
+        cancel = CancelToken()
+        finished = threading.Event()
+        threading.Thread(target=self._watch_disconnect, args=(cancel, finished), daemon=True).start()
+        try:
+            self._stream_events(agent, question, request, cancel)
+        finally:
+            finished.set()
+
+    def _stream_events(self, agent, question, request, cancel):
+        pool = self.server.pool
+        priority = BATCH if request.get('priority') == 'batch' else INTERACTIVE
+        deltas = request.get('deltas', True)
+        images = request.get('images', True)
+        generator = agent.run(
+            question,
+            priority=priority,
+            max_steps=request.get('max_steps'),
+            deadline=request.get('deadline'),
+            cancel=cancel
+        )
+        # 先取第一个事件再发送响应头：准入被拒绝时仍可以返回 503
+        try:
+            first = next(generator, None)
+        except SchedulerSaturated:
+            generator.close()
+            raise
+        except Cancelled:
+            pool.count('cancelled')
+            return
+        except Exception as e:
+            # 发送响应头之前失败（模型服务错误、参数类型错误等）：仍返回 HTTP 错误而不是直接断开
+            generator.close()
+            pool.count('errors')
+            self._send_json(500, {'error': repr(e)})
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream; charset=utf-8')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('X-Accel-Buffering', 'no')
+        self.end_headers()
+
+        started = time.perf_counter()
+        try:
+            event = first
+            while event is not None:
+                action, content, raw_content = event
+                if action != 'delta' or deltas:
+                    self._send_event(action, {
+                        'content': encode_value(content, images),
+                        'raw_content': encode_value(raw_content, images)
+                    })
+                event = next(generator, None)
+            self._send_event('done', {
+                'elapsed': round(time.perf_counter() - started, 3),
+                'tools': [list(usage) for usage in agent.tool_usage]
+            })
+            pool.count('served')
+        except (BrokenPipeError, ConnectionResetError, Cancelled):
+            # 客户端断开：中止进行中的模型请求，关闭生成器，释放准入名额和副本会话
+            pool.count('cancelled')
+        except Exception as e:
+            pool.count('errors')
+            try:
+                self._send_event('error', {'error': repr(e)})
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+        finally:
+            generator.close()
+
+
+class VRAGServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # 检查客户端是否断开的间隔（秒）
+    disconnect_poll = 0.5
+
+    def __init__(self, address, pool):
+        super().__init__(address, VRAGHandler)
+        self.pool = pool
+
+
+def main():
+    parser = argparse.ArgumentParser(description='VRAG HTTP/SSE 服务')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=4, help='同时处理的问题数')
+    parser.add_argument('--max-queue', type=int, default=16, help='等待空闲副本的请求上限')
+    parser.add_argument('--queue-timeout', type=float, default=30)
+    parser.add_argument('--base-urls', default=os.getenv('VLLM_BASE_URLS', 'http://localhost:8000/v1'),
+                        help='vLLM 副本地址，逗号分隔')
+    parser.add_argument('--corpus', default=os.getenv('VRAG_CORPUS'), help='页面图像语料库目录')
+    parser.add_argument('--guided', action='store_true', help='启用约束解码')
+    parser.add_argument('--media-dir', default=os.getenv('VRAG_MEDIA_DIR'),
+                        help='图像写入该目录并以 file:// 引用发给模型（vLLM 需 --allowed-local-media-path）')
+    parser.add_argument('--serve-media', action='store_true', help='同时启动本地 HTTP 媒体服务，以 http:// 引用图像')
+    parser.add_argument('--max-rss-mb', type=int, default=None, help='RSS 上限，超过时回收缓存并拒绝新问题')
+    parser.add_argument('--profile-memory', default=None, metavar='PATH',
+                        help='按问题做 tracemalloc 分析，报告追加写入该 jsonl 文件')
+    args = parser.parse_args()
+
+    from vrag import VRAG
+    # 流式调用模型：客户端断开时立即关闭模型请求的流
+    media = None
+    if args.media_dir:
+        from media import media_store
+        media = media_store(args.media_dir, serve=args.serve_media)
+    agent = VRAG(base_url=args.base_urls.split(','), stream=True, guided=args.guided, corpus=args.corpus, media=media)
+    try:
+        agent.warmup()
+    except Exception as e:
+        print(f"预热失败: {e}")
+    if args.max_rss_mb:
+        from memwatch import MemoryWatchdog
+        agent.watchdog = MemoryWatchdog(args.max_rss_mb * 2 ** 20, evictors=[agent.tools.clear_caches])
+    if args.profile_memory:
+        from memwatch import MemoryProfiler
+        agent.profiler = MemoryProfiler(path=args.profile_memory)
+    pool = AgentPool(agent, size=args.workers, max_queue=args.max_queue, queue_timeout=args.queue_timeout)
+    server = VRAGServer((args.host, args.port), pool)
+    print(f"VRAG 服务已启动: http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
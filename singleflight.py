@@ -0,0 +1,60 @@
+import threading
+
+
+class _Call:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """合并相同 key 的并发调用：同一时刻只有第一个调用者真正执行，其余调用者等待并共享它的结果
+
+    执行失败时异常同样抛给所有等待者；调用结束后 key 立即移除，失败不会影响之后的调用。
+    共享的结果对象会被多个调用者同时使用，调用方不能原地修改。
+    """
+
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.executed = 0
+        self.shared = 0
+
+    def do(self, key, fn, timeout=None):
+        """执行 fn() 或等待相同 key 的进行中调用；等待超过 timeout 秒时抛出 TimeoutError"""
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+                self.executed += 1
+            else:
+                self.shared += 1
+
+        if not leader:
+            if not call.done.wait(timeout):
+                raise TimeoutError(f'等待进行中的相同请求超时: {key}')
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result
+
+    def stats(self):
+        return {'executed': self.executed, 'shared': self.shared, 'in_flight': len(self.calls)}
+
+
+# 进程内所有 agent 共用，不同会话的相同检索和图片下载合并为一次
+shared_flights = SingleFlight()
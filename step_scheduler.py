@@ -0,0 +1,97 @@
+import re
+
+# 调度决策
+CONTINUE = 'continue'          # 继续正常推理
+FORCE_ANSWER = 'force_answer'  # 下一轮要求模型直接给出<answer>
+STOP = 'stop'                  # 已经强制过仍无答案，直接结束
+
+FORCE_ANSWER_PROMPT = 'please answer the question now with answer in <answer> ... </answer>'
+
+
+def normalize_query(query):
+    """归一化查询：小写、去掉多余空白和首尾标点，用于判断重复查询"""
+    if isinstance(query, list):
+        query = query[0] if query else ''
+    query = re.sub(r'\s+', ' ', str(query)).strip().lower()
+    return query.strip('\'"“”‘’.,;:!?。，；：！？')
+
+
+class StepScheduler:
+    """自适应步数调度：根据进展信号决定继续、强制回答还是提前结束
+
+    跟踪的信号：
+    - 连续解析失败（模型没有输出合法的 <search>/<bbox>/<answer>）
+    - 重复查询（与之前同类检索的查询归一化后相同）
+    - 连续没有拿到新图像的检索
+    - 总步数预算
+    任一信号超过阈值就不再继续检索，而是要求模型立即回答。
+    """
+
+    def __init__(self, max_steps=10, max_parse_failures=2, max_repeated_queries=1, max_stale_searches=2,
+                 search_actions=('search',)):
+        self.max_steps = max_steps
+        # 按 (动作, 查询) 判断重复的检索动作，通常取自工具注册表的 search_tags
+        self.search_actions = frozenset(search_actions)
+        self.max_parse_failures = max_parse_failures
+        self.max_repeated_queries = max_repeated_queries
+        self.max_stale_searches = max_stale_searches
+
+        self.steps = 0
+        self.parse_failures = 0
+        self.repeated_queries = 0
+        self.stale_searches = 0
+        self.queries = set()
+        self.forced = False
+        self.reason = None
+
+    @property
+    def remaining(self):
+        return max(self.max_steps - self.steps, 0)
+
+    def observe_action(self, action, content=''):
+        """记录本轮模型输出的动作，返回该动作是否值得执行"""
+        self.steps += 1
+        if action is None:
+            self.parse_failures += 1
+            return False
+        self.parse_failures = 0
+
+        if action in self.search_actions:
+            query = (action, normalize_query(content))
+            if query in self.queries:
+                self.repeated_queries += 1
+                return False
+            self.queries.add(query)
+        return True
+
+    def observe_result(self, new_image):
+        """记录检索结果是否带来了新图像"""
+        if new_image:
+            self.stale_searches = 0
+        else:
+            self.stale_searches += 1
+
+    def force(self, reason):
+        """外部信号（如截止时间）要求立即回答；已经强制过时返回 False"""
+        if self.forced:
+            return False
+        self.reason = reason
+        self.forced = True
+        return True
+
+    def decide(self):
+        """根据当前信号给出下一步的调度决策"""
+        if self.forced:
+            return STOP
+        if self.steps >= self.max_steps:
+            self.reason = 'budget'
+        elif self.parse_failures >= self.max_parse_failures:
+            self.reason = 'parse_failures'
+        elif self.repeated_queries >= self.max_repeated_queries:
+            self.reason = 'repeated_queries'
+        elif self.stale_searches >= self.max_stale_searches:
+            self.reason = 'no_new_images'
+        else:
+            return CONTINUE
+        self.forced = True
+        return FORCE_ANSWER
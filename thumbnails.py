@@ -0,0 +1,98 @@
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+from blobstore import image_hash
+from events import ImageRef, render
+
+
+def image_digest(image):
+    """PIL 图像或 events.ImageRef 的内容哈希"""
+    if isinstance(image, ImageRef):
+        return image.digest
+    return image_hash(image)
+
+
+class ThumbnailCache:
+    """按图像内容哈希缓存已编码的缩略图和原图字节
+
+    Streamlit 每次 rerun 都会重新编码传入 st.image 的 PIL 图像并按原尺寸发给浏览器；
+    这里按哈希缓存限宽后的 JPEG 字节，rerun 时直接复用，原图只在用户请求时才编码。
+    模块级实例在同一进程的所有会话之间共享。
+    """
+
+    def __init__(self, max_items=512, quality=85):
+        self.max_items = max_items
+        self.quality = quality
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _encode(self, image, width=None):
+        image = render(image)
+        if width is not None and image.width > width:
+            height = max(int(image.height * width / image.width), 1)
+            image = image.resize((width, height))
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        buf = BytesIO()
+        image.save(buf, format='JPEG', quality=self.quality)
+        return buf.getvalue()
+
+    def _get(self, cache_key, encode):
+        with self.lock:
+            data = self.items.get(cache_key)
+            if data is not None:
+                self.items.move_to_end(cache_key)
+                return data
+        data = encode()
+        with self.lock:
+            self.items[cache_key] = data
+            while len(self.items) > self.max_items:
+                self.items.popitem(last=False)
+        return data
+
+    def thumbnail(self, image, width=350, digest=None):
+        """限宽缩略图的 JPEG 字节；width 按显示宽度的2倍传入可兼顾高分屏
+
+        image 可以是 events.ImageRef，命中缓存时不会渲染（不绘制 bbox 标注）。
+        """
+        digest = digest or image_digest(image)
+        return self._get((digest, width), lambda: self._encode(image, width))
+
+    def full(self, image, digest=None):
+        """原尺寸 JPEG 字节，只在需要提供原图时编码一次"""
+        digest = digest or image_digest(image)
+        return self._get((digest, None), lambda: self._encode(image))
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+thumbnail_cache = ThumbnailCache()
+
+
+def show_image(image, width=350, key=None):
+    """在 Streamlit 中显示缓存的缩略图，image 可以是 PIL 图像或 events.ImageRef
+
+    传入 key 时附带“原图”按钮：点击后才编码原尺寸 JPEG 并显示下载按钮（记录在 session_state 中），
+    未点击的图像在每次 rerun 时只使用缓存的缩略图。key 需要包含运行标识，否则点击状态会带到之后运行的同一步。
+    按钮触发 rerun，只有在 rerun 后仍会重新渲染同一结果的页面（如保存了运行事件的 app.py）才能传入 key。
+    """
+    import streamlit as st
+    digest = image_digest(image)
+    st.image(thumbnail_cache.thumbnail(image, width * 2, digest), width=width)
+    if key is None:
+        return
+    requested = f'{key}_full'
+    if not st.session_state.get(requested):
+        if not st.button('⤢ 原图 / Full size', key=f'{key}_request'):
+            return
+        st.session_state[requested] = True
+    st.download_button(
+        '⬇ 下载原图 / Download',
+        data=thumbnail_cache.full(image, digest),
+        file_name=f'{digest[:12]}.jpg',
+        mime='image/jpeg',
+        key=key
+    )
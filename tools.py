@@ -0,0 +1,228 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from admission import SchedulerSaturated
+from step_scheduler import normalize_query
+
+# 约束解码（guided decoding）时各类标签内容允许的形式
+TEXT_GRAMMAR = r'[^<>]{1,512}'
+THINK_GRAMMAR = r'[^<>]{0,2048}'
+BBOX_GRAMMAR = r'\[\d{1,4}, ?\d{1,4}, ?\d{1,4}, ?\d{1,4}\]'
+
+
+class ToolTimeout(Exception):
+    """工具在超时时间内没有拿到并发名额"""
+
+
+class PartialResult(Exception):
+    """后端调用只有部分成功（如查询扩展中部分检索失败）：result 可以使用，但不写入缓存"""
+
+    def __init__(self, result, error):
+        super().__init__(str(error))
+        self.result = result
+        self.error = error
+
+
+class Observation:
+    """一次工具调用的结果：回给模型的 user_content、要产出给界面的事件，以及是否带来了新图像
+
+    new_image 为 None 表示该工具与图像检索无关，不计入步数调度的进展信号。
+    """
+
+    __slots__ = ('user_content', 'events', 'new_image', 'latency', 'cost')
+
+    def __init__(self, user_content, events=(), new_image=None):
+        self.user_content = user_content
+        self.events = list(events)
+        self.new_image = new_image
+        self.latency = 0.0
+        self.cost = 0.0
+
+
+def text_observation(text):
+    return Observation([{'type': 'text', 'text': text}])
+
+
+class Tool:
+    """一个工具的声明
+
+    - tag：模型输出中使用的标签，如 <search>...</search>
+    - fn(agent, content, timeout)：实际的后端调用（检索、裁剪等），返回原始结果
+    - observe(agent, content, raw_content, result)：把原始结果转成 Observation，为空时把结果当文本回给模型
+    - timeout：单次调用的超时（秒），同时作为等待并发名额的上限
+    - max_concurrency：进程内同时执行的调用数上限
+    - cacheable：相同（归一化后的）输入是否可以复用后端结果
+    - cost：每次调用的成本，数字或 cost(agent, content, result) 函数
+    - optional：时间预算紧张时可以跳过的工具（如裁剪）
+    - search：检索类工具，同一轮运行中（归一化后）重复的查询不再执行
+    - fallback：后端调用失败时返回的结果（如检索返回空列表），None 时抛出异常
+
+    只缓存成功且非空的结果：失败、部分失败（fn 抛出 PartialResult）和空结果不写入缓存，
+    一次限流或网络错误不会让同一查询在 cache_ttl 内一直没有结果。
+    - grammar：约束解码时标签内容的正则，默认为不含尖括号的文本
+
+    fn 和 observe 都以 agent 为第一个参数，同一个注册表可以被 agent 的多个副本（如分组 rollout）共用。
+    """
+
+    def __init__(self, name, tag, fn, observe=None, timeout=10, max_concurrency=4,
+                 cacheable=False, cost=0.0, cache_size=256, cache_ttl=600, optional=False,
+                 grammar=TEXT_GRAMMAR, search=False, fallback=None):
+        self.name = name
+        self.tag = tag
+        self.fn = fn
+        self.observe = observe
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.cacheable = cacheable
+        self.cost = cost
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.optional = optional
+        self.grammar = grammar
+        self.search = search
+        self.fallback = fallback
+
+        self.semaphore = threading.BoundedSemaphore(max_concurrency)
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+        self.cache_hits = 0
+        self.total_latency = 0.0
+        self.total_cost = 0.0
+
+    def call_cost(self, agent, content, result):
+        return self.cost(agent, content, result) if callable(self.cost) else self.cost
+
+    def _cached(self, key):
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[0] > self.cache_ttl:
+                del self.cache[key]
+                return None
+            self.cache.move_to_end(key)
+            return entry
+
+    def _store(self, key, result):
+        with self.lock:
+            self.cache[key] = (time.monotonic(), result)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def invoke(self, agent, content, timeout=None):
+        """执行后端调用（带缓存和并发上限），返回 (result, cost)"""
+        timeout = self.timeout if timeout is None else min(timeout, self.timeout)
+        key = normalize_query(content) if self.cacheable else None
+        if key is not None:
+            entry = self._cached(key)
+            if entry is not None:
+                self.cache_hits += 1
+                return entry[1], 0.0
+
+        if not self.semaphore.acquire(timeout=timeout):
+            raise ToolTimeout(f'{self.name} 并发已满，等待超时')
+        try:
+            result = self.fn(agent, content, timeout)
+        except PartialResult as e:
+            self.errors += 1
+            print(f"{self.name} 部分失败: {e.error}")
+            return e.result, self.call_cost(agent, content, e.result)
+        except SchedulerSaturated:
+            raise
+        except Exception as e:
+            if self.fallback is None:
+                raise
+            self.errors += 1
+            print(f"{self.name} 调用失败: {e}")
+            return copy.copy(self.fallback), 0.0
+        finally:
+            self.semaphore.release()
+        if key is not None and result:
+            self._store(key, result)
+        return result, self.call_cost(agent, content, result)
+
+    def stats(self):
+        return {
+            'tag': self.tag,
+            'calls': self.calls,
+            'errors': self.errors,
+            'cache_hits': self.cache_hits,
+            'avg_latency': self.total_latency / self.calls if self.calls else 0.0,
+            'total_cost': self.total_cost,
+        }
+
+
+class ToolRegistry:
+    """按标签注册工具，agent 循环统一通过 dispatch 调用，并统计每个工具的延迟和成本"""
+
+    def __init__(self, tools=()):
+        self.tools = OrderedDict()
+        for tool in tools:
+            self.register(tool)
+
+    def register(self, tool):
+        self.tools[tool.tag] = tool
+        return tool
+
+    def __contains__(self, tag):
+        return tag in self.tools
+
+    def __getitem__(self, tag):
+        return self.tools[tag]
+
+    @property
+    def tags(self):
+        return list(self.tools)
+
+    @property
+    def search_tags(self):
+        """检索类工具的标签，步数调度按这些动作判断重复查询"""
+        return [tag for tag, tool in self.tools.items() if tool.search]
+
+    def action_pattern(self, extra=('answer',)):
+        """匹配所有已注册工具标签（以及 answer）的正则"""
+        tags = '|'.join(list(self.tools) + list(extra))
+        return rf'<({tags})>(.*?)</\1>'
+
+    def guided_regex(self, tags):
+        """约束解码用的正则：可选的 <think> 段之后恰好一个 tags 中的动作，未注册的标签（如 answer）按文本约束"""
+        actions = '|'.join(
+            f'<{tag}>{self.tools[tag].grammar if tag in self.tools else TEXT_GRAMMAR}</{tag}>'
+            for tag in tags
+        )
+        return rf'(<think>{THINK_GRAMMAR}</think>\s{{0,2}})?({actions})'
+
+    def dispatch(self, agent, tag, content, raw_content='', timeout=None):
+        """调用 tag 对应的工具并返回 Observation，latency 和 cost 记录在结果和工具统计中"""
+        tool = self.tools[tag]
+        started = time.perf_counter()
+        try:
+            result, cost = tool.invoke(agent, content, timeout)
+            if tool.observe is not None:
+                observation = tool.observe(agent, content, raw_content, result)
+            else:
+                observation = text_observation(str(result))
+        except Exception:
+            tool.errors += 1
+            raise
+        finally:
+            latency = time.perf_counter() - started
+            tool.calls += 1
+            tool.total_latency += latency
+        tool.total_cost += cost
+        observation.latency = latency
+        observation.cost = cost
+        return observation
+
+    def clear_caches(self):
+        """清空所有工具的结果缓存（内存回收时调用）"""
+        for tool in self.tools.values():
+            with tool.lock:
+                tool.cache.clear()
+
+    def report(self):
+        return {tool.name: tool.stats() for tool in self.tools.values()}
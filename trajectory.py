@@ -0,0 +1,110 @@
+import json
+import os
+import time
+import uuid
+
+from PIL import Image
+
+from blobstore import DiskBlobStore
+from events import Event, ImageRef
+
+
+class TrajectoryRecorder:
+    """把 VRAG.run 的每一步追加写入 jsonl 文件
+
+    每行一条记录：question / model / step / end。图像不再以 base64 重复保存，
+    而是按内容哈希存到 image_dir 下的 PNG 文件中，记录里只保留哈希。
+    """
+
+    def __init__(self, path, image_dir=None):
+        self.path = path
+        self.image_dir = image_dir or os.path.splitext(path)[0] + '_images'
+        self.blobs = DiskBlobStore(self.image_dir)
+        self.trajectory_id = None
+        self.started = None
+
+    def _write(self, record):
+        record['id'] = self.trajectory_id
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    def _encode(self, value):
+        if isinstance(value, ImageRef):
+            value = value.render()
+        if isinstance(value, Image.Image):
+            return {'image': self.blobs.put(value).key}
+        if isinstance(value, (list, tuple)):
+            return {'list': [self._encode(v) for v in value], 'tuple': isinstance(value, tuple)}
+        return value
+
+    def start(self, question, **config):
+        self.trajectory_id = uuid.uuid4().hex
+        self.started = time.time()
+        self._write({'type': 'question', 'question': question, 'config': config, 'time': self.started})
+        return self.trajectory_id
+
+    def model_output(self, text, elapsed):
+        """记录模型原始输出及调用耗时"""
+        self._write({'type': 'model', 'text': text, 'elapsed': round(elapsed, 4)})
+
+    def step(self, action, content, raw_content, elapsed):
+        """记录一个 (action, content, raw_content) 事件及其产生耗时"""
+        self._write({
+            'type': 'step',
+            'action': action,
+            'content': self._encode(content),
+            'raw_content': self._encode(raw_content),
+            'elapsed': round(elapsed, 4)
+        })
+
+    def finish(self, error=None):
+        self._write({'type': 'end', 'total': round(time.time() - self.started, 4), 'error': error})
+
+
+def load_trajectories(path):
+    """读取文件中的全部轨迹，返回 {id: [record, ...]}，保持写入顺序"""
+    trajectories = {}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # 进程中断时最后一行可能不完整
+                continue
+            trajectories.setdefault(record['id'], []).append(record)
+    return trajectories
+
+
+def _decode(value, blobs):
+    if isinstance(value, dict) and 'image' in value:
+        return blobs.get(value['image'])
+    if isinstance(value, dict) and 'list' in value:
+        items = [_decode(v, blobs) for v in value['list']]
+        return tuple(items) if value['tuple'] else items
+    return value
+
+
+def replay(path, trajectory_id=None, image_dir=None, realtime=False):
+    """不访问模型和搜索服务，按 VRAG.run 相同的生成器接口回放一条轨迹
+
+    trajectory_id 为空时回放文件中最后一条；realtime=True 时按记录的耗时等待。
+    """
+    blobs = DiskBlobStore(image_dir or os.path.splitext(path)[0] + '_images')
+    trajectories = load_trajectories(path)
+    if not trajectories:
+        return
+    if trajectory_id is None:
+        trajectory_id = list(trajectories)[-1]
+    for record in trajectories[trajectory_id]:
+        if record['type'] != 'step':
+            continue
+        if realtime:
+            time.sleep(record['elapsed'])
+        yield Event(
+            record['action'],
+            _decode(record['content'], blobs),
+            _decode(record['raw_content'], blobs)
+        )
@@ -1,94 +1,683 @@
 import base64
 import json
 import re
-import requests
 import math
+import time
+from contextlib import nullcontext
 from io import BytesIO
 
-from openai import OpenAI
-from PIL import Image, ImageDraw
+# openai、requests、PIL 在首次使用时才导入，减少冷启动时的导入开销
+from router import ReplicaRouter
+from admission import default_scheduler, INTERACTIVE, SchedulerSaturated
+from query_expansion import expand_query, reciprocal_rank_fusion
+from singleflight import shared_flights
+from step_scheduler import StepScheduler, normalize_query, STOP, FORCE_ANSWER, FORCE_ANSWER_PROMPT
+from deadline import Deadline, NORMAL, ANSWER_NOW
+from memwatch import run_guard
+from cancel import CancelToken
+from events import Event, ImageRef
+from resolution import ResolutionPolicy, FIRST_VIEW, CROP, PAGE
+from tools import Tool, ToolRegistry, Observation, PartialResult, text_observation, BBOX_GRAMMAR
 
 prompt_ins = '''Answer the given question. You must conduct reasoning inside <think> and </think> first every time you get new information. After reasoning, if you find you lack some knowledge, you can call a search engine by <search> query </search> and user will return the searched results. Every time you retrieve an image, you have the option to crop it to obtain a clearer view, the format for coordinates is <bbox>[x1, y1, x2, y2]</bbox>. You can search as many times as your want. If you find no further external knowledge needed, you can directly provide the answer inside <answer> and </answer>, without detailed illustrations. For example, <answer> Beijing </answer>. Question: {question}
 '''
 
+def parse_thought(response_content, tags=('answer', 'search', 'bbox')):
+    """提取推理内容，返回 (thought, full_match)"""
+    pattern = r'<think>(.*?)</think>'
+    match = re.search(pattern, response_content, re.DOTALL)
+    # 新增：判断匹配是否成功，避免 NoneType 错误
+    if match:
+        return match.group(1).strip(), match.group(0)
+    # 如果没有think标签，提取answer/search/bbox标签之前的内容
+    action_pattern = rf'<({"|".join(tags)})>'
+    action_match = re.search(action_pattern, response_content)
+    if action_match:
+        thought = response_content[:action_match.start()].strip()
+    else:
+        thought = response_content.strip()  # 全部内容作为thought
+    return thought, thought
+
+
+def parse_action(response_content, pattern=r'<(search|answer|bbox)>(.*?)</\1>'):
+    """提取动作，返回 (action, content, raw_content)，没有合法动作时 action 为 None"""
+    match = re.search(pattern, response_content, re.DOTALL)
+    if match:
+        return match.group(1), match.group(2).strip(), match.group(0)
+    return None, '', None
+
+
+def parse_bbox(content):
+    """解析 <bbox> 内容为 [x1, y1, x2, y2]，格式不合法时返回 None 而不是抛出异常"""
+    numbers = re.findall(r'-?\d+(?:\.\d+)?', str(content))
+    if len(numbers) != 4:
+        return None
+    x1, y1, x2, y2 = (float(n) for n in numbers)
+    if x2 <= x1 or y2 <= y1:
+        return None
+    return [x1, y1, x2, y2]
+
+
+def fit_pixels(image, max_pixels, min_pixels):
+    """按总像素数把图像缩放到 [min_pixels, max_pixels] 之间并转为 RGB"""
+    if (image.width * image.height) > max_pixels:
+        resize_factor = math.sqrt(max_pixels / (image.width * image.height))
+        width, height = int(image.width * resize_factor), int(image.height * resize_factor)
+        image = image.resize((width, height))
+
+    if (image.width * image.height) < min_pixels:
+        resize_factor = math.sqrt(min_pixels / (image.width * image.height))
+        width, height = int(image.width * resize_factor), int(image.height * resize_factor)
+        image = image.resize((width, height))
+
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    return image
+
+
+def jpeg_data_url(jpeg_bytes):
+    base64_string = base64.b64encode(jpeg_bytes).decode("utf-8")
+    return f"data:image;base64,{base64_string}"
+
+
+def candidate_url(candidate):
+    """检索候选的图像地址：候选是带 url/title/source 的字典，也兼容直接给出的地址字符串"""
+    return candidate['url'] if isinstance(candidate, dict) else candidate
+
+
+def candidate_caption(search_results, image_path):
+    """选中图像在检索结果中的标题和来源，没有时返回空字符串"""
+    for candidate in search_results:
+        if isinstance(candidate, dict) and candidate['url'] == image_path:
+            return ' '.join(filter(None, (candidate.get('title'), candidate.get('source'))))
+    return ''
+
+
+def _api_connection_error():
+    """延迟导入 openai 的连接异常类型，供 except 子句使用"""
+    from openai import APIConnectionError
+    return APIConnectionError
+
+
+class SearchThrottled(Exception):
+    """检索服务返回 429，调度器已暂停发放令牌"""
+
+
 class VRAG:
     def __init__(self, 
                 base_url='http://localhost:8000/v1', 
                 search_url='https://api.bing.microsoft.com/v7.0/images/search',
                 generator=True,
-                api_key='EMPTY'):
+                api_key='EMPTY',
+                scheduler=None,
+                stream=False,
+                guided=False,
+                corpus=None,
+                media=None):
         
-        self.client = OpenAI(base_url=base_url, api_key=api_key)
+        # base_url 可以是单个地址，也可以是多个 vLLM 副本地址的列表
+        self.router = ReplicaRouter(base_url, api_key=api_key)
         self.model = '/Users/xuhaohao/Desktop/大模型相关论文/Qwen3-VL-2B-Instruct'
         self.search_url = search_url
 
         self.max_pixels = 512 * 28 * 28
         self.min_pixels = 256 * 28 * 28
+        # 按用途分配分辨率：检索结果第一眼低分辨率，裁剪和文字密集图像更高，None 时固定用 max_pixels
+        self.resolution = ResolutionPolicy()
+        self.pixel_budget = None
+        # 时间预算紧张时的降级参数
+        self.degraded_max_pixels = 256 * 28 * 28
+        self.degraded_max_tokens = 512
+        self.answer_max_tokens = 256
+        self.deadline = None
+        self.degraded = False
+        # 当前占用 agent 上运行状态（图像列表等）的运行，run 结束时据此判断是否释放
+        self.active_run = None
+        # 内存看门狗和按问题的分配分析（memwatch），默认关闭
+        self.watchdog = None
+        self.profiler = None
+        self.image_raw = []
+        self.image_input = []
+        self.image_path = []
         self.repeated_nums = 1
         self.max_steps = 10
+        # 自适应步数调度的阈值
+        self.max_parse_failures = 2
+        self.max_repeated_queries = 1
+        self.max_stale_searches = 2
 
         self.generator = generator
+        # 流式输出：模型生成的增量以 'delta' 事件实时产出，供界面边生成边渲染
+        self.stream = stream
+        # 约束解码：通过 vLLM 的 structured outputs 保证每次输出恰好一个合法动作
+        self.guided = guided
+        self.priority = INTERACTIVE
+        self.recorder = None
+        # 共享的准入控制与限速调度器，默认所有会话共用一个
+        self.scheduler = scheduler or default_scheduler()
+        self._http = None
+        # 相同检索和图片下载的并发请求合并（进程内所有 agent 共用）
+        self.flights = shared_flights
+        # 本地重排：预取全部候选图像后按与查询的相关度选择发给模型的一张，None 时取第一张
+        self.use_reranker = True
+        self._reranker = None
+        # 本地页面图像语料库（corpus.PageStore 或其目录）：设置后 <search> 检索语料库而不是网页
+        if isinstance(corpus, str):
+            from corpus import PageStore
+            corpus = PageStore(corpus)
+        self.corpus = corpus
+        # 图像按引用发给模型（media.MediaStore 或其目录），None 时内联 base64
+        if isinstance(media, str):
+            from media import MediaStore
+            media = MediaStore(media)
+        self.media = media
+        # 查询扩展：每次检索并发发出的改写查询数，1 表示只用原查询
+        self.query_expansions = 3
+        # 工具注册表：每个工具单独配置超时、并发上限、缓存和成本
+        self.tools = default_tools()
+        self.tool_usage = []
+
+    @property
+    def client(self):
+        """第一个副本的 OpenAI 客户端，首次访问时才创建；请求路由仍由 router 负责"""
+        return self.router.replicas[0].client
+
+    @client.setter
+    def client(self, client):
+        self.router.replicas[0].client = client
+
+    @property
+    def http(self):
+        """搜索和图片下载共用的 HTTP 连接池，首次使用时创建"""
+        if self._http is None:
+            import requests
+            self._http = requests.Session()
+        return self._http
+
+    @property
+    def reranker(self):
+        """本地 CPU 重排器，首次使用时创建（导入 numpy）"""
+        if self._reranker is None and self.use_reranker:
+            from reranker import default_reranker
+            self._reranker = default_reranker()
+        return self._reranker
+
+    @reranker.setter
+    def reranker(self, reranker):
+        self._reranker = reranker
+        self.use_reranker = reranker is not None
+
+    def pixels_for(self, kind, image):
+        """这张图发送时的 max_pixels：有分辨率策略时按用途和本轨迹剩余的像素预算分配"""
+        cap = self.degraded_max_pixels if self.degraded else None
+        if self.pixel_budget is None:
+            return cap or self.max_pixels
+        return self.pixel_budget.allocate(kind, image, self.min_pixels, cap)
+
+    def process_image(self, image, max_pixels=None):
+        from PIL import Image
 
-    def process_image(self, image):
         if isinstance(image, dict):
             image = Image.open(BytesIO(image['bytes']))
         elif isinstance(image, str):
             image = Image.open(image)
 
-        if (image.width * image.height) > self.max_pixels:
-            resize_factor = math.sqrt(self.max_pixels / (image.width * image.height))
-            width, height = int(image.width * resize_factor), int(image.height * resize_factor)
-            image = image.resize((width, height))
-
-        if (image.width * image.height) < self.min_pixels:
-            resize_factor = math.sqrt(self.min_pixels / (image.width * image.height))
-            width, height = int(image.width * resize_factor), int(image.height * resize_factor)
-            image = image.resize((width, height))
-
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
-        
+        if max_pixels is None:
+            max_pixels = self.degraded_max_pixels if self.degraded else self.max_pixels
+        image = fit_pixels(image, max_pixels, self.min_pixels)
         byte_stream = BytesIO()
         image.save(byte_stream, format="JPEG")
-        byte_array = byte_stream.getvalue()
-        base64_encoded_image = base64.b64encode(byte_array)
-        base64_string = base64_encoded_image.decode("utf-8")
-        base64_qwen = f"data:image;base64,{base64_string}"
+        return image, self.image_url(byte_stream.getvalue())
 
-        return image, base64_qwen
-    
-    def search(self, query):
-        import os
-        api_key = os.getenv('SERPER_API_KEY')
-    
-        headers = {
-            'X-API-KEY': api_key,
-            'Content-Type': 'application/json'
-        }
-    
+    def image_url(self, jpeg_bytes):
+        """发给模型的图像地址：设置了 media 时写入媒体目录并返回 file:// 或本地 http:// 引用，否则内联 base64"""
+        if self.media is not None:
+            return self.media.put(jpeg_bytes)
+        return jpeg_data_url(jpeg_bytes)
+
+    def encode_image(self, image_path, image_raw):
+        """把选中的图像转成 (image_input, base64)；语料库页面在分辨率一致时直接使用预编码的结果"""
+        is_page = self.corpus is not None and str(image_path).startswith('corpus://')
+        max_pixels = self.pixels_for(PAGE if is_page else FIRST_VIEW, image_raw)
+        if is_page and self.corpus.matches(max_pixels, self.min_pixels):
+            page_id = int(image_path[len('corpus://'):])
+            return self.corpus.page_input(page_id), self.image_url(self.corpus.page_jpeg(page_id))
+        return self.process_image(image_raw, max_pixels)
+
+    def serper(self, endpoint, query, timeout=10):
+        """调用 Serper 接口（images、search 等），返回解析后的 JSON；被限流或请求失败时抛出异常
+
+        相同接口和（归一化后）相同查询的并发请求通过 single-flight 合并为一次，结果为共享对象，不能原地修改。
+        """
         search_query = query[0] if isinstance(query, list) else query
-        payload = json.dumps({"q": search_query, "num": 5})
-    
+
+        def request():
+            import os
+            headers = {
+                'X-API-KEY': os.getenv('SERPER_API_KEY'),
+                'Content-Type': 'application/json'
+            }
+            payload = json.dumps({"q": search_query, "num": 5})
+            with self.scheduler.slot('serper', self.priority, self.time_left(self.scheduler.queue_timeout)):
+                response = self.http.post(
+                    f'https://google.serper.dev/{endpoint}',
+                    headers=headers,
+                    data=payload,
+                    timeout=timeout
+                )
+            if response.status_code == 429:
+                # 配额/限流错误：通知调度器暂停发放令牌，而不是静默重试
+                retry_after = float(response.headers.get('Retry-After', 1))
+                self.scheduler.throttle('serper', retry_after)
+                raise SearchThrottled(f'搜索被限流: HTTP 429, {retry_after}s 后重试')
+            response.raise_for_status()
+            return response.json()
+
+        return self.flights.do(('serper', endpoint, normalize_query(search_query)), request, timeout)
+
+    def search(self, query, timeout=10):
+        """图像检索，返回前5个候选 {'url', 'title', 'source'}，标题和来源供重排使用
+
+        设置了语料库时检索本地页面，候选地址为 corpus://<页面编号>。
+        检索失败（限流、网络错误）时抛出异常，由工具注册表返回空结果且不缓存。
+        """
+        if self.corpus is not None:
+            return self.corpus.search(query, k=5)
+        results = self.serper('images', query, timeout)
+        return [
+            {'url': img['imageUrl'], 'title': img.get('title', ''), 'source': img.get('source', '')}
+            for img in results.get('images', [])[:5]
+        ]
+
+    def expanded_search(self, search, query, timeout=10, limit=5):
+        """查询扩展：把查询改写为多个版本并发检索，再用倒数排名融合合并结果
+
+        总延迟约等于最慢的一次检索，而不是多轮模型调用；预算紧张时只检索原查询。
+        全部检索失败时抛出第一个错误；部分失败时抛出 tools.PartialResult，融合结果照常使用但不缓存。
+        """
+        queries = expand_query(query, 1 if self.degraded else self.query_expansions)
+        if len(queries) == 1:
+            return search(queries[0], timeout=timeout)
+
+        def attempt(q):
+            try:
+                return search(q, timeout=timeout), None
+            except SchedulerSaturated:
+                raise
+            except Exception as e:
+                return None, e
+
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=len(queries)) as pool:
+            outcomes = list(pool.map(attempt, queries))
+        result_lists = [results for results, error in outcomes if error is None]
+        errors = [error for _, error in outcomes if error is not None]
+        if not result_lists:
+            raise errors[0]
+        fused = reciprocal_rank_fusion(result_lists, key=candidate_url)[:limit]
+        if errors:
+            raise PartialResult(fused, errors[0])
+        return fused
+
+    def fetch_image(self, image_path):
+        """加载检索到的图像，支持URL和本地路径，失败返回None
+
+        并发下载同一地址时只下载一次，多个调用者共享同一个图像对象（只读）。
+        """
+        from PIL import Image
+
+        if self.corpus is not None and image_path.startswith('corpus://'):
+            # 直接映射分片中的原分辨率像素，不经过解码；裁剪也从这里读取
+            return self.corpus.page(int(image_path[len('corpus://'):]))
+
+        def load():
+            if image_path.startswith('http'):
+                response = self.http.get(image_path, timeout=self.time_left(10))
+                response.raise_for_status()
+                image = Image.open(BytesIO(response.content))
+            else:
+                image = Image.open(image_path)
+            # 在共享之前完成解码，避免多个线程同时触发延迟加载
+            image.load()
+            return image
+
         try:
-            response = requests.post(
-                'https://google.serper.dev/images',
-                headers=headers,
-                data=payload,
-                timeout=10
-            )
-            results = response.json()
-            return [img['imageUrl'] for img in results.get('images', [])[:5]]
+            return self.flights.do(('image', image_path), load, self.time_left(10))
         except Exception as e:
-            print(f"搜索失败: {e}")
-            return []
+            print(f"图像加载失败: {e}")
+            return None
 
-    
-    def run(self, question):
+    def retrieve_image(self, query, seen_paths=()):
+        """检索并选出一张未见过（或未超过重复次数）的图像，返回 (image_path, image)"""
+        return self.select_image(query, self.search(query), seen_paths)
+
+    def first_new_image(self, search_results, seen_paths=()):
+        """从检索结果中加载第一张未见过的图像；不修改 search_results（可能来自缓存）"""
+        seen_paths = list(seen_paths)
+        for candidate in search_results:
+            if self.deadline is not None and self.deadline.expired:
+                break
+            image_path = candidate_url(candidate)
+            if seen_paths.count(image_path) >= self.repeated_nums:
+                continue
+            image_raw = self.fetch_image(image_path)
+            if image_raw is not None:
+                return image_path, image_raw
+        return None, None
+
+    def select_image(self, query, search_results, seen_paths=()):
+        """选出发给模型的图像：并发预取所有未见过的候选，由重排器一次批量打分后取最高分
+
+        没有重排器或预算紧张时退回 first_new_image。
+        """
+        if self.reranker is None or self.degraded:
+            return self.first_new_image(search_results, seen_paths)
+        seen_paths = list(seen_paths)
+        positions, candidates = [], []
+        for i, candidate in enumerate(search_results):
+            if seen_paths.count(candidate_url(candidate)) < self.repeated_nums:
+                positions.append(i)
+                candidates.append(candidate)
+        if not candidates:
+            return None, None
+
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=len(candidates)) as pool:
+            images = list(pool.map(lambda c: self.fetch_image(candidate_url(c)), candidates))
+        loaded = [i for i, image in enumerate(images) if image is not None]
+        if not loaded:
+            return None, None
+        scores = self.reranker.score_images(
+            query,
+            [candidates[i] for i in loaded],
+            [images[i] for i in loaded],
+            [positions[i] for i in loaded]
+        )
+        best = loaded[int(scores.argmax())]
+        return candidate_url(candidates[best]), images[best]
+
+    def observe_search(self, content, raw_content, search_results):
+        """图像检索工具的结果处理：选出新图像、缩放编码，并产出 search_image 事件"""
+        image_path, image_raw = self.select_image(content, search_results, self.image_path)
+        if image_raw is None:
+            observation = text_observation('No new image found for this query')
+            observation.new_image = False
+            return observation
+        self.image_path.append(image_path)
+        image_input, img_base64 = self.encode_image(image_path, image_raw)
+        self.image_raw.append(image_raw)
+        self.image_input.append(image_input)
+        user_content = [{
+            'type': 'image_url',
+            'image_url': {
+                'url': img_base64
+            }
+        }]
+        image = ImageRef(image_input, caption=candidate_caption(search_results, image_path))
+        return Observation(user_content, [Event('search_image', image, raw_content)], new_image=True)
+
+    def observe_crop(self, content, raw_content, bbox):
+        """裁剪工具的结果处理：在最近一张图上裁剪，并产出 crop_image 事件
+
+        事件的 raw_content 是带 bbox 标注的上一张图的句柄，只有消费者渲染时才复制和绘制。
+        """
+        if not self.image_input:
+            return text_observation('There is no image to crop, please search for an image first')
+        if bbox is None:
+            return text_observation('Invalid bbox, please use <bbox>[x1, y1, x2, y2]</bbox> with coordinates on the last image')
+        # 把坐标限制在最近一张图内
+        width, height = self.image_input[-1].size
+        bbox = [min(max(bbox[0], 0), width), min(max(bbox[1], 0), height),
+                min(max(bbox[2], 0), width), min(max(bbox[3], 0), height)]
+        crop_region = self.crop(self.image_raw[-1], self.image_input[-1], bbox)
+        image_input, img_base64 = self.process_image(crop_region, self.pixels_for(CROP, crop_region))
+        user_content = [{
+            'type': 'image_url',
+            'image_url': {
+                'url': img_base64
+            }
+        }]
+        self.image_raw.append(crop_region)
+        self.image_input.append(image_input)
+
+        events = []
+        if self.generator:
+            events.append(Event('crop_image', ImageRef(self.image_input[-1]), ImageRef(self.image_input[-2], bbox)))
+        return Observation(user_content, events)
+
+    def crop(self, image_raw, image_input, bbox):
+        """把模型在缩放图上给出的 bbox 映射回原图并加边距裁剪"""
+        input_w, input_h = image_input.size
+        raw_w, raw_h = image_raw.size
+        crop_region_bbox = bbox[0] * raw_w / input_w, bbox[1] * raw_h / input_h, bbox[2] * raw_w / input_w, bbox[3] * raw_h / input_h
+        pad_size = 56
+        crop_region_bbox = [max(crop_region_bbox[0]-pad_size,0), max(crop_region_bbox[1]-pad_size,0), min(crop_region_bbox[2]+pad_size,raw_w), min(crop_region_bbox[3]+pad_size,raw_h)]
+        return image_raw.crop(crop_region_bbox)
+
+    def warmup(self, search=True):
+        """预热：导入重模块、建立连接池、确认模型可用并预填充共享指令前缀
+
+        自动扩容出的新 worker 调用一次后，第一个问题即可达到稳定状态的延迟。
+        返回各阶段耗时（秒）。
+        """
+        timings = {}
+        started = time.perf_counter()
+        from PIL import Image
+        # 编码一张最小的图片，加载 JPEG 编码器
+        self.process_image(Image.new('RGB', (28, 28)))
+        timings['imports'] = time.perf_counter() - started
+
+        for replica in self.router.replicas:
+            started = time.perf_counter()
+            # models.list 同时建立到该副本的 TCP 连接池
+            if self.router.probe(replica):
+                try:
+                    # 只生成 1 个 token，让 vLLM 缓存所有问题共享的指令前缀
+                    replica.client.chat.completions.create(
+                        messages=self.initial_messages(''),
+                        stream=False,
+                        **self._completion_kwargs(max_tokens=1)
+                    )
+                except Exception as e:
+                    print(f"预热请求失败 {replica.base_url}: {e}")
+            timings[replica.base_url] = time.perf_counter() - started
+
+        if search:
+            started = time.perf_counter()
+            try:
+                # 提前完成到搜索服务的 TLS 握手，连接留在连接池中复用
+                self.http.head('https://google.serper.dev', timeout=5)
+            except Exception as e:
+                print(f"搜索服务预热失败: {e}")
+            timings['search'] = time.perf_counter() - started
+        return timings
+
+    def time_left(self, cap=None):
+        """本次运行可以分给下一次调用的超时（秒），不超过 cap；没有截止时间时返回 cap"""
+        if self.deadline is None:
+            return cap
+        return self.deadline.timeout(cap)
+
+    def run(self, question, priority=INTERACTIVE, recorder=None, max_steps=None, deadline=None, cancel=None):
+        """准入控制后执行推理循环，系统饱和时抛出 SchedulerSaturated
+
+        产出 events.Event，可以按 (action, content, raw_content) 解包；search_image、crop_image 中的图像
+        是 events.ImageRef 句柄，需要显示时调用 render（裁剪的 bbox 标注在这时才绘制）。
+
+        max_steps 只对本次运行生效，不修改共享 agent 上的默认值。
+
+        deadline 为总时间预算（秒或 deadline.Deadline，从调用 run 开始计时，包含排队时间）。
+        剩余时间作为超时传给每次模型调用和检索；预算紧张时跳过裁剪、降低图像分辨率和生成长度，
+        只剩一步的时间时强制模型回答。
+
+        recorder 为 trajectory.TrajectoryRecorder 时，每一步连同模型输出和耗时一起写入轨迹文件，
+        之后可用 trajectory.replay 无网络回放。
+
+        设置了 self.watchdog（memwatch.MemoryWatchdog）时，内存超限会抛出 MemoryPressure；
+        设置了 self.profiler（memwatch.MemoryProfiler）时，报告本次运行后仍存活的分配。
+        运行结束后立即释放本问题的图像。
+
+        消费者关闭生成器（或生成器被回收）时，进行中的流式模型请求立即断开，不再发起新的模型调用和检索。
+        cancel 为 cancel.CancelToken 时可以在其他线程中取消运行，run 抛出 cancel.Cancelled；
+        此时非流式调用也改为内部流式请求（不产出 delta 事件），取消时可以立即中止。
+        """
+        self.priority = priority
+        self.recorder = recorder
+        # 取消令牌和是否流式调用只属于本次运行，不放在 agent 上：同一 agent 上交错的生成器互不影响
+        token = cancel or CancelToken()
+        stream = self.stream or cancel is not None
+        deadline = Deadline.of(deadline)
+        with run_guard(self.profiler, self.watchdog, question):
+            try:
+                yield from self._admitted(question, max_steps, deadline, token, stream)
+            except GeneratorExit:
+                token.cancel('generator closed')
+                raise
+            finally:
+                # agent 上的图像已经属于之后开始的运行时不释放
+                if self.active_run is token:
+                    self.release()
+
+    def release(self):
+        """释放本问题检索和裁剪得到的图像"""
         self.image_raw = []
         self.image_input = []
         self.image_path = []
+
+    def _admitted(self, question, max_steps, deadline, cancel, stream):
+        recorder = self.recorder
+        queue_timeout = None if deadline is None else deadline.timeout(self.scheduler.queue_timeout)
+        with self.scheduler.admit(self.priority, queue_timeout), self.router.session() as session:
+            # 同一问题的所有步骤都发往同一副本，复用其前缀缓存
+            self.session = session
+            if recorder is None:
+                yield from self._run(question, max_steps, deadline, cancel, stream)
+                return
+
+            recorder.start(
+                question,
+                max_steps=max_steps or self.max_steps,
+                deadline=None if deadline is None else deadline.budget,
+                replica=session.replica.base_url
+            )
+            error = None
+            try:
+                started = time.perf_counter()
+                for event in self._run(question, max_steps, deadline, cancel, stream):
+                    # 流式增量已包含在 model_output 记录的完整输出中，不单独记录
+                    if event[0] != 'delta':
+                        recorder.step(*event, time.perf_counter() - started)
+                    yield event
+                    if event[0] != 'delta':
+                        started = time.perf_counter()
+            except Exception as e:
+                error = repr(e)
+                raise
+            finally:
+                recorder.finish(error)
+
+    def _completion_kwargs(self, guided_tags=None, **kwargs):
+        """chat.completions.create 的公共参数，kwargs 覆盖或追加参数
+
+        有截止时间时，剩余时间作为本次请求的超时，预算紧张时缩短生成长度。
+        开启约束解码时，输出被限制为可选的 <think> 加恰好一个 guided_tags 中的动作（默认所有工具和 answer），
+        并在动作的闭合标签处停止生成。
+        """
+        extra_body = {
+            "chat_template_kwargs": {
+                "enable_thinking": False  # 禁用thinking模式
+            }
+        }
+        params = dict(
+            model=self.model,
+            max_tokens=self.degraded_max_tokens if self.degraded else 2048,
+            extra_body=extra_body
+        )
+        if self.guided:
+            tags = guided_tags or self.tools.tags + ['answer']
+            params['stop'] = [f'</{tag}>' for tag in tags]
+            # 保留闭合标签，parse_action 仍按完整标签解析
+            extra_body['include_stop_str_in_output'] = True
+            extra_body['structured_outputs'] = {'regex': self.tools.guided_regex(tags)}
+        if self.deadline is not None:
+            params['timeout'] = self.deadline.timeout()
+        params.update(kwargs)
+        return params
+
+    def _chat(self, messages, cancel=None, **kwargs):
+        """在当前会话绑定的副本上调用模型，副本连接失败时迁移到其他副本重试一次
+
+        kwargs 直接透传给 chat.completions.create，例如分组采样时的 n 和 temperature。
+        """
+        for attempt in range(2):
+            if cancel is not None:
+                cancel.check()
+            try:
+                with self.scheduler.slot('llm', self.priority, self.time_left(self.scheduler.queue_timeout)), \
+                        self.session.request() as client:
+                    return self._deadline_client(client).chat.completions.create(
+                        messages=messages,
+                        stream=False,
+                        **self._completion_kwargs(**kwargs)
+                    )
+            except _api_connection_error():
+                # 超过截止时间的请求不再换副本重试
+                if attempt == 1 or len(self.router.replicas) == 1 or self._out_of_time():
+                    raise
+                self.session.failover()
+
+    def _deadline_client(self, client):
+        """有截止时间时关闭 openai 客户端的自动重试：超时后再重试会让一步用掉数倍的剩余时间"""
+        if self.deadline is None:
+            return client
+        return client.with_options(max_retries=0)
+
+    def _out_of_time(self):
+        return self.deadline is not None and self.deadline.expired
+
+    def _stream_chat(self, messages, cancel=None, **kwargs):
+        """流式调用模型：每收到一段增量就产出 ('delta', 增量, '')，最终返回完整输出
+
+        生成器被关闭或运行被取消时立即关闭流，vLLM 发现连接断开后中止生成并释放名额。
+        cancel 为本次运行的 CancelToken；只是为了可以取消而使用流式请求（self.stream 为 False）时不产出增量。
+        """
+        chunks = []
+        for attempt in range(2):
+            if cancel is not None:
+                cancel.check()
+            try:
+                with self.scheduler.slot('llm', self.priority, self.time_left(self.scheduler.queue_timeout)), \
+                        self.session.request() as client:
+                    stream = self._deadline_client(client).chat.completions.create(
+                        messages=messages,
+                        stream=True,
+                        **self._completion_kwargs(**kwargs)
+                    )
+                    try:
+                        with nullcontext() if cancel is None else cancel.aborting(stream.close):
+                            for chunk in stream:
+                                if not chunk.choices:
+                                    continue
+                                delta = chunk.choices[0].delta.content
+                                if delta:
+                                    chunks.append(delta)
+                                    if self.generator and self.stream:
+                                        yield Event('delta', delta)
+                                if self._out_of_time():
+                                    # 超过截止时间：停止生成，使用已经得到的部分输出
+                                    break
+                    finally:
+                        stream.close()
+                return ''.join(chunks)
+            except _api_connection_error():
+                # 已经输出过内容时不能换副本重来
+                if chunks or attempt == 1 or len(self.router.replicas) == 1 or self._out_of_time():
+                    raise
+                self.session.failover()
+
+    def initial_messages(self, question):
         prompt = prompt_ins.format(question=question)
-        messages = [dict(
+        return [dict(
             role="user",
             content=[
                 {
@@ -98,20 +687,64 @@ class VRAG:
             ]
         )]
 
-        max_steps = self.max_steps
+    def _fallback_answer(self):
+        if self.generator:
+            yield Event('answer', 'Sorry, I can not retrieval something about the question.')
+
+    def _run(self, question, max_steps=None, deadline=None, cancel=None, stream=None):
+        stream = self.stream if stream is None else stream
+        self.active_run = cancel
+        self.deadline = deadline
+        self.degraded = False
+        self.pixel_budget = None if self.resolution is None else self.resolution.start()
+        self.image_raw = []
+        self.image_input = []
+        self.image_path = []
+        self.tool_usage = []
+        messages = self.initial_messages(question)
+
+        step_scheduler = StepScheduler(
+            max_steps=max_steps or self.max_steps,
+            max_parse_failures=self.max_parse_failures,
+            max_repeated_queries=self.max_repeated_queries,
+            max_stale_searches=self.max_stale_searches,
+            search_actions=self.tools.search_tags
+        )
+        self.step_scheduler = step_scheduler
         while True:
             ## assistant
-            response = self.client.chat.completions.create(
-                model="/Users/xuhaohao/Desktop/大模型相关论文/Qwen3-VL-2B-Instruct",
-                messages=messages,
-                stream=False,
-                max_tokens=2048,
-                extra_body={
-                    "chat_template_kwargs": {
-                    "enable_thinking": False  # 禁用thinking模式
-        }}
-            )
-            response_content = response.choices[0].message.content
+            if cancel is not None:
+                cancel.check()
+            step_started = time.perf_counter()
+            chat_kwargs = {}
+            if deadline is not None:
+                if deadline.expired:
+                    yield from self._fallback_answer()
+                    return
+                level = deadline.level()
+                self.degraded = level != NORMAL
+                if level == ANSWER_NOW:
+                    chat_kwargs['max_tokens'] = self.answer_max_tokens
+            if step_scheduler.forced:
+                # 已经要求回答：约束解码时只允许输出 <answer>
+                chat_kwargs['guided_tags'] = ['answer']
+            try:
+                if stream:
+                    response_content = yield from self._stream_chat(messages, cancel=cancel, **chat_kwargs)
+                else:
+                    response = self._chat(messages, cancel=cancel, **chat_kwargs)
+                    response_content = response.choices[0].message.content
+            except _api_connection_error():
+                # 模型调用超时且已经没有剩余时间：直接给出兜底回答而不是抛出超时
+                if not self._out_of_time():
+                    raise
+                yield from self._fallback_answer()
+                return
+            elapsed = time.perf_counter() - step_started
+            if deadline is not None:
+                deadline.observe_model(elapsed)
+            if self.recorder is not None:
+                self.recorder.model_output(response_content, elapsed)
             #增加调试输出
             print(f"\n【调试模型输出:{response_content[:200]}\n")
             messages.append(dict(
@@ -122,112 +755,99 @@ class VRAG:
                 }]
             ))
             ## think
-            pattern = r'<think>(.*?)</think>'
-            match = re.search(pattern, response_content, re.DOTALL)
-            ## think
-            # 新增：判断匹配是否成功，避免 NoneType 错误
-            if match:
-                thought = match.group(1).strip()
-                full_match = match.group(0)
-            else:
-    # 如果没有think标签，提取answer/search/bbox标签之前的内容
-                action_pattern = r'<(answer|search|bbox)>'
-                action_match = re.search(action_pattern, response_content)
-                if action_match:
-                    thought = response_content[:action_match.start()].strip()
-                    full_match = thought
-                else:
-                    thought = response_content.strip()  # 全部内容作为thought
-                    full_match = thought
+            thought, full_match = parse_thought(response_content, self.tools.tags + ['answer'])
 
             if self.generator:
-                yield 'think', thought, full_match  # 这里改用上面定义的 full_match
+                yield Event('think', thought, full_match)  # 这里改用上面定义的 full_match
 
             ## opration
-            pattern = r'<(search|answer|bbox)>(.*?)</\1>'
-            match = re.search(pattern, response_content, re.DOTALL)
-            if match:
-                raw_content = match.group(0)
-                content = match.group(2).strip()
-                action = match.group(1)
-            else:
-                content = ''
-                action = None
+            action, content, raw_content = parse_action(response_content, self.tools.action_pattern())
 
             ## whether end
             if action == 'answer':
                 if self.generator:
-                    yield 'answer', content, raw_content
+                    yield Event('answer', content, raw_content)
                 return  # 结束循环
     
-            if max_steps == 0:
-                if self.generator:
-                    yield 'answer', 'Sorry, I can not retrieval something about the question.', ''
+            # 已经强制要求回答但模型仍未回答，提前结束
+            if step_scheduler.decide() == STOP:
+                yield from self._fallback_answer()
                 return
 
             # 其他action继续处理
             if self.generator and action:
-                yield action, content, raw_content
+                yield Event(action, content, raw_content)
 
 
             ## action
-            if action == 'search':
-                search_results = self.search(content)
-                while len(search_results) > 0:
-                    image_path = search_results.pop(0)
-                    if self.image_path.count(image_path) >= self.repeated_nums:
-                        continue
-                    else:
-                        self.image_path.append(image_path)
-                        break
-                
-                image_raw = Image.open(image_path)
-                image_input, img_base64 = self.process_image(image_raw)
-                user_content=[{
-                    'type': 'image_url',
-                    'image_url': {
-                        'url': img_base64
-                    }
+            worth_running = step_scheduler.observe_action(action, content)
+            if action is None:
+                tags = ', '.join(f'<{tag}> ... </{tag}>' for tag in self.tools.tags + ['answer'])
+                user_content = [{
+                    'type': 'text',
+                    'text': f'No valid action found, please use {tags}'
                 }]
-                self.image_raw.append(image_raw)
-                self.image_input.append(image_input)
-                if self.generator:
-                    yield 'search_image', self.image_input[-1], raw_content
-            elif action == 'bbox':
-                bbox = json.loads(content)
-                input_w, input_h = self.image_input[-1].size
-                raw_w, raw_h = self.image_raw[-1].size
-                crop_region_bbox = bbox[0] * raw_w / input_w, bbox[1] * raw_h / input_h, bbox[2] * raw_w / input_w, bbox[3] * raw_h / input_h
-                pad_size = 56
-                crop_region_bbox = [max(crop_region_bbox[0]-pad_size,0), max(crop_region_bbox[1]-pad_size,0), min(crop_region_bbox[2]+pad_size,raw_w), min(crop_region_bbox[3]+pad_size,raw_h)]
-                crop_region = self.image_raw[-1].crop(crop_region_bbox)
-                image_input, img_base64 = self.process_image(crop_region)
-                user_content=[{
-                    'type': 'image_url',
-                    'image_url': {
-                        'url': img_base64
-                    }
+            elif not worth_running:
+                user_content = [{
+                    'type': 'text',
+                    'text': 'You have already searched this query, please try a different query or answer the question'
                 }]
-                self.image_raw.append(crop_region)
-                self.image_input.append(image_input)
-
+            elif self.degraded and action in self.tools and self.tools[action].optional:
+                user_content = [{
+                    'type': 'text',
+                    'text': f'Not enough time left for <{action}>, please answer with the information you have'
+                }]
+            elif action in self.tools:
+                if cancel is not None:
+                    cancel.check()
+                observation = self.tools.dispatch(self, action, content, raw_content, timeout=self.time_left())
+                self.tool_usage.append((action, observation.latency, observation.cost))
+                if observation.new_image is not None:
+                    step_scheduler.observe_result(new_image=observation.new_image)
+                user_content = observation.user_content
                 if self.generator:
-                    image_to_draw = self.image_input[-2].copy()
-                    draw = ImageDraw.Draw(image_to_draw)
-                    draw.rectangle(bbox, outline=(160, 32, 240), width=7)
-                    yield 'crop_image', self.image_input[-1], image_to_draw
+                    for event in observation.events:
+                        yield Event.of(event)
 
-            max_steps -= 1
-            if max_steps == 0:
+            if deadline is not None:
+                deadline.observe_step(time.perf_counter() - step_started)
+            # 根据进展信号和剩余时间决定是否提前要求回答
+            if step_scheduler.decide() == FORCE_ANSWER or (
+                    deadline is not None and deadline.level() == ANSWER_NOW and step_scheduler.force('deadline')):
                 user_content.append({
                     'type': 'text',
-                    'text': 'please answer the question now with answer in <answer> ... </answer>' 
+                    'text': FORCE_ANSWER_PROMPT
                 })
             messages.append(dict(
                 role='user',
                 content=user_content
             ))
 
+
+def serper_cost(agent, query, result):
+    """Serper 每次查询约 0.001 美元；按 agent 实际发出的改写查询数计算（与 expanded_search 一致）"""
+    return 0.001 * len(expand_query(query, 1 if agent.degraded else agent.query_expansions))
+
+
+def default_tools():
+    """VRAG 的默认工具：图像检索（<search>）和裁剪（<bbox>）"""
+    return ToolRegistry([
+        Tool(
+            'image_search', 'search',
+            fn=lambda agent, query, timeout: agent.expanded_search(agent.search, query, timeout),
+            observe=VRAG.observe_search,
+            timeout=10, max_concurrency=4, cacheable=True, search=True, fallback=[],
+            cost=serper_cost
+        ),
+        Tool(
+            'crop', 'bbox',
+            fn=lambda agent, content, timeout: parse_bbox(content),
+            observe=VRAG.observe_crop,
+            timeout=5, max_concurrency=8, optional=True, grammar=BBOX_GRAMMAR
+        ),
+    ])
+
+
 if __name__ == '__main__':
     agent = VRAG()
     generator = agent.run('How are u?')